@@ -20,5 +20,9 @@ setup(
         "flask-sqlalchemy",
         "rfc3339-validator",
         "SQLAlchemy",
-    ]
+    ],
+    extras_require={
+        # vectorized batch scoring, pure Python is used without it
+        "numpy": ["numpy"],
+    }
 )
@@ -10,6 +10,7 @@ from sportbet.constants import *
 
 db = SQLAlchemy()
 cache = Cache()
+response_cache = Cache()
 
 def create_app(test_config=None):
     """
@@ -33,6 +34,48 @@ def create_app(test_config=None):
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
         CACHE_TYPE="FileSystemCache",
         CACHE_DIR=os.path.join(app.instance_path, "cache"),
+        # Game bet statistics: cache lifetime in seconds (dropped anyway
+        # when a bet on the game changes) and number of top exact scores
+        STATS_CACHE_TIMEOUT=3600,
+        STATS_TOP_SCORES=5,
+        # Seconds an API key (or unknown key) is kept in the in-process key cache
+        API_KEY_CACHE_TTL=300,
+        # Requests per minute per API key and resource class (None = no limit,
+        # e.g. 600 enables it for keys without ApiKey.rate_limit, which
+        # overrides it), and optional SQLite file for sharing the rate limits
+        # between worker processes (None = process memory)
+        RATE_LIMIT=None,
+        RATE_LIMIT_STORE=None,
+        # URL converter lookup cache: number of events, members and games
+        # kept, and seconds they are kept (changes in other processes)
+        CONVERTER_CACHE_SIZE=1024,
+        CONVERTER_CACHE_TTL=30,
+        # Response cache of the read endpoints: backend ("simple", "filesystem",
+        # "null" or any Flask-Caching CACHE_TYPE, None = same as CACHE_TYPE)
+        # and seconds a response is kept, streamed responses are cached up to
+        # the maximum size (characters)
+        RESPONSE_CACHE_TYPE=None,
+        RESPONSE_CACHE_TIMEOUT=300,
+        RESPONSE_CACHE_MAX_SIZE=1048576,
+        # Collections: maximum page size (query parameter limit), also the
+        # page size when no limit is given
+        MAX_PAGE_SIZE=1000,
+        # Maximum number of bets in one bet batch request
+        BET_BATCH_MAX_SIZE=500,
+        # Maximum number of game results in one admin result batch request
+        RESULT_BATCH_MAX_SIZE=500,
+        # Projected betting status: process pool size (0 = in request process,
+        # e.g. os.cpu_count() enables the pool), scenario and time limits, and
+        # default goal distribution
+        PROJECTION_WORKERS=0,
+        PROJECTION_SAMPLES=10000,
+        PROJECTION_MAX_SAMPLES=1000000,
+        PROJECTION_TIME_BUDGET=5.0,
+        PROJECTION_MAX_TIME_BUDGET=30.0,
+        PROJECTION_DISTRIBUTION="poisson",
+        PROJECTION_HOME_GOALS=1.5,
+        PROJECTION_GUEST_GOALS=1.2,
+        PROJECTION_MAX_GOALS=6,
     )
 
     if test_config is None:
@@ -47,23 +90,43 @@ def create_app(test_config=None):
 
     db.init_app(app)
     cache.init_app(app)
+    from sportbet.responsecache import BACKENDS
+    response_type = app.config["RESPONSE_CACHE_TYPE"] or app.config["CACHE_TYPE"]
+    response_cache.init_app(app, config={
+        "CACHE_TYPE": BACKENDS.get(response_type, response_type),
+        "CACHE_DIR": os.path.join(app.instance_path, "response-cache"),
+        "CACHE_DEFAULT_TIMEOUT": app.config["RESPONSE_CACHE_TIMEOUT"],
+        # "null" is a valid choice for disabling the response cache
+        "CACHE_NO_NULL_WARNING": True,
+    })
 
     # own package imports here to avoid circular dependencies
     from . import models
+    from . import scoring
     from . import api
     from sportbet.utils import EventConverter
     from sportbet.utils import MemberConverter
     from sportbet.utils import GameConverter
+    from sportbet.utils import compile_validators
 
     app.cli.add_command(models.db_init)
+    app.cli.add_command(models.db_upgrade)
     app.cli.add_command(models.db_clear)
     app.cli.add_command(models.db_fill)
+    app.cli.add_command(scoring.standings_rebuild)
+
+    # Compile configured scoring rule sets into lookup tables
+    for name, points in app.config.get("SCORING_RULES", {}).items():
+        scoring.register_rules(name, **points)
 
     # Add converters for URL-name <--> Python object mapping
     app.url_map.converters["event"] = EventConverter
     app.url_map.converters["member"] = MemberConverter
     app.url_map.converters["game"] = GameConverter
 
+    # Request body validators are compiled once and shared by all requests
+    compile_validators()
+
     app.register_blueprint(api.api_bp)
 
     print("APP instance path: " + app.instance_path)
@@ -1,19 +1,41 @@
 """
 Sportbet package resource (URL to resource class) initializations.
 """
-from flask import Blueprint
+from flask import Blueprint, abort
 from flask_restful import Api
 
+from sportbet import db, identity, responsecache
+from sportbet.utils import error_response
 from sportbet.resources.event import EventCollection, EventItem
 from sportbet.resources.member import MemberCollection, MemberItem
-from sportbet.resources.game import GameCollection, GameItem
-from sportbet.resources.bet import BetsAll, BetsMember
-from sportbet.resources.betstatus import BetStatus
+from sportbet.resources.game import GameCollection, GameItem, GameStats, GameResults
+from sportbet.resources.bet import BetsAll, BetsMember, BetsBatch
+from sportbet.resources.betstatus import BetStatus, BetStatusProjection
 
 URL_PRE = "/api"
 api_bp = Blueprint("api", __name__, url_prefix=URL_PRE)
 api = Api(api_bp)
 
+@api_bp.url_value_preprocessor
+def resolve_url_objects(_endpoint, values):
+    """ Event, member and game objects of the URL for the resource methods """
+    if not values:
+        return
+    # the event's generation is read before the objects are loaded
+    event_id = identity.cached_event_id(values)
+    if event_id is not None:
+        responsecache.request_generation(event_id)
+    missing = identity.resolve(values)
+    if missing is not None:
+        abort(error_response(404, missing.__name__ + " not found"))
+    event = values.get("event")
+    if event is not None and event.id != event_id:
+        # event id not cached: read the generation now and load the objects again
+        responsecache.request_generation(event.id)
+        for value in values.values():
+            if isinstance(value, db.Model):
+                db.session.refresh(value)
+
 api.add_resource(EventCollection, "/events/")
 api.add_resource(EventItem, "/events/<event:event>/")
 
@@ -22,10 +44,16 @@ api.add_resource(MemberItem, "/<event:event>/members/<member:member>/")
 
 api.add_resource(GameCollection, "/<event:event>/games/")
 api.add_resource(GameItem, "/<event:event>/games/<game:game>/")
+api.add_resource(GameStats, "/<event:event>/games/<game:game>/stats/")
+api.add_resource(GameResults, "/<event:event>/results/")
 
 api.add_resource(BetsAll, "/<event:event>/bets/", "/<event:event>/bets/game/<game:game>/")
 api.add_resource(BetsMember, "/<event:event>/bets/<member:member>/")
+api.add_resource(BetsBatch, "/<event:event>/bets/<member:member>/batch/")
 
 # GET: list betting points for all members (1st path) or given member (2nd path)
 api.add_resource(BetStatus, "/<event:event>/betstatus/",
                             "/<event:event>/betstatus/<member:member>/")
+
+# GET: maximum reachable points and win probabilities over the remaining games
+api.add_resource(BetStatusProjection, "/<event:event>/projection/")
@@ -7,6 +7,9 @@ SPORTBET_NAMESPACE = "sportbet"
 SPORTBET_API_KEY_NAME = "Sportbet-API-Key"
 JSON = "application/json"
 MASON = "application/vnd.mason+json"
+# compact representation of the collections, see utils.compact_request()
+COMPACT = "compact"
+MASON_COMPACT = MASON + '; profile="' + COMPACT + '"'
 LINK_RELATIONS_URL = "/link-relations/"
 ERROR_PROFILE = "/profiles/error/"
 EVENT_PROFILE = "/profiles/event/"
@@ -0,0 +1,178 @@
+"""
+Object lookups for the URL converters.
+
+The converters give UrlName values, which resolve() replaces with objects
+before the view is called. A member or game is loaded together with its
+event in one statement, and the event segment of the URL is the object's
+event, so a URL resolves with at most one query.
+
+Primary keys of resolved events, members and games are kept in a bounded
+process-level LRU keyed by (event name, name), so that a warm lookup is a
+session.get() by primary key: an identity map hit or one primary key query,
+which always loads the current column values. Removed or renamed objects
+drop their LRU entries when the session commits, and entries expire after
+CONVERTER_CACHE_TTL seconds so that changes made by other processes are
+seen too.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event as sa_event, inspect
+from sqlalchemy.orm import Session, contains_eager, joinedload
+
+from sportbet import db
+from sportbet.models import Event, Member, Game
+
+_SESSION_KEY = "identity_changes"
+# name column of each cached model
+_NAME_COLUMNS = {Event: "name", Member: "nickname", Game: "game_nbr"}
+_lock = threading.Lock()
+# (database URL, model name, event name, name) -> (expiry time, primary key, event id)
+_objects = OrderedDict()
+
+class UrlName:
+    """ Name of an object in the URL, replaced with the object by resolve() """
+    def __init__(self, model, name):
+        self.model = model
+        self.name = name
+
+def resolve(values):
+    """
+    Replace the UrlName values of the view arguments with their objects,
+    members and games are looked up within the URL's event.
+        Parameters:
+        - values: view arguments of the request, changed in place
+        Returns:
+        - model (Event, Member or Game) of an object not found, or None
+    """
+    names = {arg: value for arg, value in values.items() if isinstance(value, UrlName)}
+    event_name = names.pop("event").name if "event" in names else None
+    event = None
+    for arg, url_name in names.items():
+        obj = lookup(url_name.model, url_name.name, event_name)
+        if obj is None:
+            if event_name is not None and lookup(Event, event_name) is None:
+                return Event
+            return url_name.model
+        values[arg] = obj
+        event = obj.event
+    if event_name is not None:
+        if event is None:
+            event = lookup(Event, event_name)
+            if event is None:
+                return Event
+        values["event"] = event
+    return None
+
+def cached_event_id(values):
+    """
+    Event id of the URL from the lookup cache, without a query.
+        Parameters:
+        - values: view arguments of the request (UrlName values)
+        Returns:
+        - event id, or None if the URL has no event or it is not cached
+    """
+    names = [value for value in values.values() if isinstance(value, UrlName)]
+    event_name = next((value.name for value in names if value.model is Event), None)
+    if event_name is None:
+        return None
+    children = [value for value in names if value.model is not Event]
+    if children:
+        cache_key = (str(db.engine.url), children[0].model.__name__, event_name,
+                     children[0].name)
+    else:
+        cache_key = (str(db.engine.url), Event.__name__, None, event_name)
+    with _lock:
+        cached = _objects.get(cache_key)
+    return cached[2] if cached is not None else None
+
+def lookup(model, name, event_name=None):
+    """
+    Object of the given model by its name, within the event if given.
+    A member or game is loaded with its event.
+        Parameters:
+        - model: Event, Member or Game
+        - name: value of the model's name column (from URL)
+        - event_name: event name, or None for a lookup across all events
+        Returns:
+        - the object attached to the current session, or None if not found
+    """
+    cache_key = (str(db.engine.url), model.__name__, event_name, name)
+    now = time.monotonic()
+    with _lock:
+        cached = _objects.get(cache_key)
+        if cached is not None:
+            if cached[0] > now:
+                _objects.move_to_end(cache_key)
+            else:
+                del _objects[cache_key]
+                cached = None
+    obj = None
+    if cached is not None:
+        obj = _get(model, cached[1], name, event_name)
+        if obj is None:
+            # removed or renamed by another process
+            with _lock:
+                _objects.pop(cache_key, None)
+    if obj is None:
+        query = model.query.filter_by(**{_NAME_COLUMNS[model]: name})
+        if model is not Event:
+            query = query.join(model.event).options(contains_eager(model.event))
+            if event_name is not None:
+                query = query.filter(Event.name == event_name)
+        obj = query.first()
+        if obj is None:
+            return None
+        _store(cache_key, obj, now)
+    return obj
+
+def _get(model, obj_id, name, event_name):
+    """ Object by primary key, None if it no longer has the given name (and event) """
+    options = [] if model is Event else [joinedload(model.event)]
+    obj = db.session.get(model, obj_id, options=options)
+    if obj is None or getattr(obj, _NAME_COLUMNS[model]) != name:
+        return None
+    if event_name is not None and model is not Event and obj.event.name != event_name:
+        return None
+    return obj
+
+def _store(cache_key, obj, now):
+    config = current_app.config
+    with _lock:
+        event_id = obj.id if isinstance(obj, Event) else obj.event_id
+        _objects[cache_key] = (now + config["CONVERTER_CACHE_TTL"], obj.id, event_id)
+        _objects.move_to_end(cache_key)
+        while len(_objects) > config["CONVERTER_CACHE_SIZE"]:
+            _objects.popitem(last=False)
+
+def clear():
+    """ Drop all cached objects """
+    with _lock:
+        _objects.clear()
+
+@sa_event.listens_for(Session, "after_flush")
+def _track_changes(session, flush_context):
+    changes = session.info.setdefault(_SESSION_KEY, set())
+    for obj in session.dirty:
+        # the cache keys are names, other column changes do not matter
+        if type(obj) in _NAME_COLUMNS and\
+           inspect(obj).attrs[_NAME_COLUMNS[type(obj)]].history.has_changes():
+            changes.add((type(obj).__name__, obj.id))
+    for obj in session.deleted:
+        if type(obj) in _NAME_COLUMNS:
+            changes.add((type(obj).__name__, obj.id))
+
+@sa_event.listens_for(Session, "after_commit")
+def _apply_changes(session):
+    changes = session.info.pop(_SESSION_KEY, None)
+    if changes:
+        with _lock:
+            for cache_key in [key for key, entry in _objects.items()
+                              if (key[1], entry[1]) in changes]:
+                del _objects[cache_key]
+
+@sa_event.listens_for(Session, "after_soft_rollback")
+def _discard_changes(session, previous_transaction):
+    session.info.pop(_SESSION_KEY, None)
@@ -0,0 +1,70 @@
+"""
+In-process API key cache for request authentication.
+
+Keys are looked up by their hash (the ApiKey primary key) and kept for
+API_KEY_CACHE_TTL seconds. Unknown keys are not cached, so the cache holds
+at most the keys in the database and random keys in requests cannot grow
+it. Added, changed or removed ApiKey rows drop the cache when the session
+commits.
+"""
+from collections import namedtuple
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import event as sa_event
+from sqlalchemy.orm import Session
+
+from sportbet import db
+from sportbet.models import ApiKey
+
+CachedKey = namedtuple("CachedKey", ["key", "event_id", "admin", "rate_limit"])
+
+_SESSION_KEY = "api_key_changes"
+_lock = threading.Lock()
+# (database URL, key hash) -> (expiry time, CachedKey)
+_keys = {}
+
+def lookup(key_hash):
+    """
+    API key with the given hash.
+        Parameters:
+        - key_hash: ApiKey.key_hash() of the key in the request
+        Returns:
+        - CachedKey or None if the key does not exist
+    """
+    cache_key = (str(db.engine.url), key_hash)
+    now = time.monotonic()
+    with _lock:
+        cached = _keys.get(cache_key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    db_key = db.session.get(ApiKey, key_hash)
+    if db_key is None:
+        return None
+    entry = CachedKey(db_key.key, db_key.event_id, bool(db_key.admin), db_key.rate_limit)
+    with _lock:
+        for expired in [key for key, (expiry, _) in _keys.items() if expiry <= now]:
+            del _keys[expired]
+        _keys[cache_key] = (now + current_app.config["API_KEY_CACHE_TTL"], entry)
+    return entry
+
+def clear():
+    """ Drop all cached keys """
+    with _lock:
+        _keys.clear()
+
+@sa_event.listens_for(Session, "after_flush")
+def _track_changes(session, flush_context):
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    if any(isinstance(obj, ApiKey) for obj in changed):
+        session.info[_SESSION_KEY] = True
+
+@sa_event.listens_for(Session, "after_commit")
+def _apply_changes(session):
+    if session.info.pop(_SESSION_KEY, False):
+        clear()
+
+@sa_event.listens_for(Session, "after_soft_rollback")
+def _discard_changes(session, previous_transaction):
+    session.info.pop(_SESSION_KEY, None)
@@ -2,21 +2,73 @@
 API sportbet-app database model defintions and click-commands for
 initializing, filling and clearing the database.
 """
+from functools import wraps
 import hashlib
+import inspect as pyinspect
 import secrets
 import click
 from flask.cli import with_appcontext
-from sportbet import db
+from sqlalchemy import UniqueConstraint, inspect
+from sqlalchemy.schema import CreateColumn, CreateTable
+from sportbet import db, cache, response_cache
 
 # ----------------- DATABASE MODEL ----------------
 #  API database classes.
 # -------------------------------------------------
 
+class FrozenDict(dict):
+    """ Immutable dictionary for the memoized JSON schemas, shared by all requests """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("FrozenDict is immutable")
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __deepcopy__(self, memo):
+        return self
+
+class FrozenList(list):
+    """ Immutable list for the memoized JSON schemas (still an array for jsonschema) """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("FrozenList is immutable")
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = clear = extend = insert = pop = remove = reverse = sort = _immutable
+
+    def __deepcopy__(self, memo):
+        return self
+
+def _freeze(value):
+    """ Immutable copy of a JSON-like value """
+    if isinstance(value, dict):
+        return FrozenDict((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return FrozenList(_freeze(item) for item in value)
+    return value
+
+def frozen_schema(func):
+    """
+    Memoize a json_schema() method: the schema of each variant (arguments) is
+    built once and returned as an immutable FrozenDict.
+    """
+    signature = pyinspect.signature(func)
+    schemas = {}
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = tuple(bound.arguments.items())
+        schema = schemas.get(key)
+        if schema is None:
+            schema = schemas[key] = _freeze(func(*args, **kwargs))
+        return schema
+    return wrapper
+
 class ApiKey(db.Model):
     """ API-key model for API method call authentication. """
     key = db.Column(db.String(32), nullable=False, unique=True, primary_key=True)
     event_id = db.Column(db.Integer, db.ForeignKey("event.id"), nullable=True)
     admin =  db.Column(db.Boolean, default=False)
+    # requests per minute and resource, None = app config RATE_LIMIT
+    rate_limit = db.Column(db.Integer, nullable=True)
     event = db.relationship("Event", uselist=False)
 
     @staticmethod
@@ -35,6 +87,9 @@ class Event(db.Model):
     """ Event database model, parent class for members, games and bets """
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), unique=True, nullable=False)
+    # name of the scoring rule set, see sportbet/scoring.py
+    scoring = db.Column(db.String(32), nullable=False, default="standard",
+                        server_default="standard")
     games = db.relationship("Game", cascade="all, delete-orphan", back_populates="event")
     # members = db.relationship("Member", secondary=event_members, back_populates="event_members")
     members = db.relationship("Member", cascade="all, delete-orphan", back_populates="event")
@@ -42,14 +97,18 @@ class Event(db.Model):
     def deserialize(self, dic):
         """ From JSON to Python object - exception handling in schema validation """
         self.name = dic["name"]
+        if "scoring" in dic:
+            self.scoring = dic["scoring"]
 
     def serialize(self):
         """ From Python object to JSON """
         return {
             "name": self.name,
+            "scoring": self.scoring
         }
 
     @staticmethod
+    @frozen_schema
     def json_schema():
         """ Schema method for JSON-request validation and hypermedia """
         schema = {
@@ -61,15 +120,24 @@ class Event(db.Model):
             "description": "Event name",
             "type": "string"
         }
+        props["scoring"] = {
+            "description": "Scoring rule set name",
+            "type": "string"
+        }
         return schema
 
 class Member(db.Model):
     """ Member database model in event, parent for member bets """
+    # nickname is unique in event, also the index for event member lookups
+    __table_args__ = (db.UniqueConstraint("event_id", "nickname",
+                                          name="uq_member_event_nickname"),)
     id = db.Column(db.Integer, primary_key=True)
-    nickname = db.Column(db.String(64), unique=True, nullable=False)
+    nickname = db.Column(db.String(64), nullable=False)
     # email = db.Column(db.String(64), unique=True, nullable=False)
     event_id = db.Column(db.Integer, db.ForeignKey("event.id", ondelete="CASCADE"))
     bets = db.relationship("Bet", cascade="all, delete-orphan", back_populates="member")
+    standing = db.relationship("Standing", uselist=False, cascade="all, delete-orphan",
+                               back_populates="member")
     # events = db.relationship("Event", secondary=event_members, back_populates="members")
     event = db.relationship("Event", back_populates="members")
 
@@ -84,6 +152,7 @@ class Member(db.Model):
         }
 
     @staticmethod
+    @frozen_schema
     def json_schema():
         """ Schema method for JSON-request validation and hypermedia """
         schema = {
@@ -99,15 +168,19 @@ class Member(db.Model):
 
 class Game(db.Model):
     """ Game database model in event, parent for game bets """
+    # game number is unique in event, also the index for event game lookups
+    __table_args__ = (db.UniqueConstraint("event_id", "game_nbr", name="uq_game_event_nbr"),)
     id = db.Column(db.Integer, primary_key=True)
     event_id = db.Column(db.Integer, db.ForeignKey("event.id", ondelete="CASCADE"))
-    game_nbr = db.Column(db.String(64), unique=True, nullable=False)
+    game_nbr = db.Column(db.String(64), nullable=False)
     home_team = db.Column(db.String(64), nullable=False)
     guest_team = db.Column(db.String(64), nullable=False)
     home_goals = db.Column(db.Integer, nullable=False)
     guest_goals = db.Column(db.Integer, nullable=False)
     event = db.relationship("Event", back_populates="games")
     bets = db.relationship("Bet", cascade="all, delete-orphan", back_populates="game")
+    snapshot = db.relationship("StandingSnapshot", uselist=False, cascade="all, delete-orphan",
+                               back_populates="game")
 
     def deserialize(self, dic, full_format=True):
         """ From JSON to Python object - exception handling in schema validation """
@@ -129,6 +202,7 @@ class Game(db.Model):
         }
 
     @staticmethod
+    @frozen_schema
     def json_schema(only_goals=False):
         """ Schema method for JSON-request validation and hypermedia """
         schema = {
@@ -164,6 +238,10 @@ class Game(db.Model):
 
 class Bet(db.Model):
     """ Bet database model for a member/game """
+    # one bet per member and game (also the index for member's bets),
+    # and index for game's bets
+    __table_args__ = (db.UniqueConstraint("member_id", "game_id", name="uq_bet_member_game"),
+                      db.Index("ix_bet_game_id", "game_id"))
     id = db.Column(db.Integer, primary_key=True)
     game_id = db.Column(db.Integer, db.ForeignKey("game.id", ondelete="CASCADE"))
     member_id = db.Column(db.Integer, db.ForeignKey("member.id", ondelete="CASCADE"))
@@ -191,6 +269,7 @@ class Bet(db.Model):
         }
 
     @staticmethod
+    @frozen_schema
     def json_schema(full_format=True):
         """ Schema method for JSON-request validation and hypermedia """
         schema = {
@@ -228,6 +307,35 @@ class Bet(db.Model):
         }
         return schema
 
+class Standing(db.Model):
+    """
+    Materialized betting points of a member, updated by the write paths
+    changing bets or game results (see sportbet/scoring.py). Every member
+    has a row, created with the member.
+    """
+    __table_args__ = (db.Index("ix_standing_event_points", "event_id", "points"),)
+    member_id = db.Column(db.Integer, db.ForeignKey("member.id", ondelete="CASCADE"),
+                          primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey("event.id", ondelete="CASCADE"),
+                         nullable=False)
+    points = db.Column(db.Integer, nullable=False, default=0)
+    member = db.relationship("Member", back_populates="standing")
+
+class StandingSnapshot(db.Model):
+    """
+    Betting status after a game result was set. Snapshots of an event are
+    ordered by seq (order of result inputs), ranking is a packed array of
+    (member id, points) pairs, highest points first (see sportbet/scoring.py).
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey("event.id", ondelete="CASCADE"),
+                         nullable=False)
+    game_id = db.Column(db.Integer, db.ForeignKey("game.id", ondelete="CASCADE"),
+                        unique=True, nullable=False)
+    seq = db.Column(db.Integer, nullable=False)
+    ranking = db.Column(db.LargeBinary, nullable=False)
+    game = db.relationship("Game", back_populates="snapshot")
+
 # ----------------------------------------------------------------------------
 # ----------------- CLICK COMMANDS TO INIT, POPULATE AND CLEAR DATABASE ------
 # ----------------------------------------------------------------------------
@@ -237,10 +345,85 @@ def db_init():
     """ Initialize database """
     db.create_all()
 
+@click.command("db-upgrade")
+@with_appcontext
+def db_upgrade():
+    """
+    Upgrade SQLite database created with an older version in place: add new
+    tables, columns and indexes, and rebuild tables with changed constraints.
+    """
+    engine = db.engine
+    if engine.dialect.name != "sqlite":
+        click.echo("Only SQLite databases can be upgraded")
+        return
+    with engine.connect() as conn:
+        inspector = inspect(conn)
+        existing = set(inspector.get_table_names())
+        # table rebuilds drop tables referenced by foreign keys
+        conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        conn.commit()
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    conn.exec_driver_sql("ALTER TABLE " + table.name + " ADD COLUMN " +\
+                                         str(CreateColumn(column).compile(dialect=engine.dialect)))
+                    click.echo(table.name + ": column " + column.name + " added")
+            if _constraints_changed(inspector, table):
+                _rebuild_table(conn, table, columns)
+                click.echo(table.name + ": table rebuilt with new constraints")
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+                    click.echo(table.name + ": index " + index.name + " created")
+        conn.commit()
+        for row in conn.exec_driver_sql("PRAGMA foreign_key_check"):
+            click.echo("Foreign key violation: " + str(tuple(row)))
+        conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+    db.create_all()
+    # materialized betting status of the upgraded data
+    from sportbet.scoring import rebuild_standings
+    for event in Event.query.all():
+        rebuild_standings(event)
+    db.session.commit()
+    click.echo("Database upgraded")
+
+def _constraints_changed(inspector, table):
+    """ Check whether the unique constraints of the table differ from the model """
+    stored = {tuple(constraint["column_names"])
+              for constraint in inspector.get_unique_constraints(table.name)}
+    model = {tuple(column.name for column in constraint.columns)
+             for constraint in table.constraints if isinstance(constraint, UniqueConstraint)}
+    model.update((column.name,) for column in table.columns if column.unique)
+    return stored != model
+
+def _rebuild_table(conn, table, old_columns):
+    """
+    Re-create the table from the model and copy its rows. Bets duplicating
+    an earlier bet of the same member and game are dropped (latest kept).
+    """
+    new_name = "new_" + table.name
+    create = str(CreateTable(table).compile(dialect=conn.dialect))
+    conn.exec_driver_sql(create.replace("CREATE TABLE " + table.name,
+                                        "CREATE TABLE " + new_name, 1))
+    columns = ", ".join(column.name for column in table.columns if column.name in old_columns)
+    copy = "INSERT INTO " + new_name + " (" + columns + ") SELECT " + columns +\
+           " FROM " + table.name
+    if table.name == "bet":
+        copy += " WHERE id IN (SELECT MAX(id) FROM bet GROUP BY member_id, game_id)"
+    conn.exec_driver_sql(copy)
+    conn.exec_driver_sql("DROP TABLE " + table.name)
+    conn.exec_driver_sql("ALTER TABLE " + new_name + " RENAME TO " + table.name)
+
 @click.command("db-clear")
 @with_appcontext
 def db_clear():
     """ Clear all content in database """
+    db.session.query(StandingSnapshot).delete()
+    db.session.query(Standing).delete()
     db.session.query(Bet).delete()
     db.session.query(Game).delete()
     db.session.query(Member).delete()
@@ -249,6 +432,11 @@ def db_clear():
     db.session.commit()
     db.session.remove()
     db.drop_all()
+    cache.clear()
+    response_cache.clear()
+    from sportbet import identity, keycache
+    identity.clear()
+    keycache.clear()
 
 @click.command("db-fill")
 @with_appcontext
@@ -306,4 +494,8 @@ def db_fill():
     # ADMIN-key: 0M7xu94E2argHrgEJS4tQdZWfaHmdIFW6IPZv82sQhU
     # USER-key: 4p9cZapvkQbjH_YtjJ5qQq0AttdyJZdjaiAPoa-odIk
 
+    # Materialized betting status for the initial bets
+    from sportbet.scoring import rebuild_standings
+    rebuild_standings(event)
+
     db.session.commit()
@@ -0,0 +1,226 @@
+"""
+Projected betting status: maximum reachable points and win probabilities of
+event members over the possible outcomes of the games not played yet.
+
+Functions here work on plain lists (or NumPy arrays) only, so that the
+simulation can be run in a process pool without database access.
+"""
+import itertools
+import math
+import multiprocessing
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from sportbet.scoring import np, score_batch
+
+# Simulated scenarios per time budget check
+_CHUNK = 2000
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+def goal_probabilities(distribution, mean, max_goals):
+    """
+    Probabilities of a team scoring 0...max_goals goals.
+        Parameters:
+        - distribution: "poisson" (with the given mean) or "uniform"
+        - mean: expected goals for the poisson distribution
+        - max_goals: highest goal count, the distribution is truncated here
+        Returns:
+        - list of max_goals + 1 probabilities summing to 1
+    """
+    if distribution == "uniform" or mean <= 0:
+        weights = [1.0] * (max_goals + 1)
+    else:
+        weights = [math.exp(-mean) * mean ** goals / math.factorial(goals)
+                   for goals in range(max_goals + 1)]
+    total = sum(weights)
+    return [weight / total for weight in weights]
+
+def game_outcomes(home_probabilities, guest_probabilities):
+    """
+    All results of a game with their probabilities, teams scoring independently.
+        Returns:
+        - list of ((home_goals, guest_goals), probability)
+    """
+    return [((home, guest), home_prob * guest_prob)
+            for home, home_prob in enumerate(home_probabilities)
+            for guest, guest_prob in enumerate(guest_probabilities)]
+
+def game_points(rules, outcomes, bets, member_count):
+    """
+    Points of every member for every outcome of one game.
+        Parameters:
+        - rules: ScoringRules object
+        - outcomes: list of ((home_goals, guest_goals), probability)
+        - bets: list of (member index, bet home goals, bet guest goals)
+        - member_count: number of members
+        Returns:
+        - matrix [outcome][member] of points (NumPy array if available)
+    """
+    matrix = [[0] * member_count for _ in outcomes]
+    if bets:
+        members, bet_home, bet_guest = zip(*bets)
+        count = len(bets)
+        for row, ((home, guest), _) in zip(matrix, outcomes):
+            points = score_batch(bet_home, bet_guest, [home] * count, [guest] * count, rules)
+            for member, pts in zip(members, points):
+                row[member] += int(pts)
+    if np is not None:
+        return np.asarray(matrix, dtype=np.int64).reshape(len(outcomes), member_count)
+    return matrix
+
+def max_bet_points(rules, bet_home, bet_guest):
+    """ Highest points the given bet can get from any result of the game """
+    return max(rules.points(bet_home, bet_guest, home, guest)
+               for home in range(bet_home + 3) for guest in range(bet_guest + 3))
+
+def _simulate(current, points, probabilities, samples, seed, deadline):
+    """
+    Sample game outcomes and count (tie-shared) wins of each member. Runs
+    until the sample count is reached or the deadline (time.time()) passes.
+        Returns:
+        - (wins per member, sampled scenario count)
+    """
+    member_count = len(current)
+    done = 0
+    if np is not None:
+        rng = np.random.default_rng(seed)
+        wins = np.zeros(member_count)
+        base = np.asarray(current, dtype=np.int64)
+        while done < samples and time.time() < deadline:
+            size = min(_CHUNK, samples - done)
+            totals = np.tile(base, (size, 1))
+            for game, probs in zip(points, probabilities):
+                totals += game[rng.choice(len(probs), size=size, p=probs)]
+            leaders = totals == totals.max(axis=1, keepdims=True)
+            wins += (leaders / leaders.sum(axis=1, keepdims=True)).sum(axis=0)
+            done += size
+        return wins.tolist(), done
+    rnd = random.Random(seed)
+    wins = [0.0] * member_count
+    indexes = [range(len(probs)) for probs in probabilities]
+    while done < samples and time.time() < deadline:
+        for _ in range(min(_CHUNK, samples - done)):
+            totals = list(current)
+            for game, idx, probs in zip(points, indexes, probabilities):
+                row = game[rnd.choices(idx, weights=probs)[0]]
+                totals = [total + pts for total, pts in zip(totals, row)]
+            _add_wins(wins, totals, 1.0)
+            done += 1
+    return wins, done
+
+def _enumerate(current, points, probabilities, deadline):
+    """
+    Go through every combination of game outcomes, weighting wins with the
+    scenario probability.
+        Returns:
+        - (wins per member, enumerated probability mass, complete flag)
+    """
+    wins = [0.0] * len(current)
+    covered = 0.0
+    combinations = itertools.product(*[range(len(probs)) for probs in probabilities])
+    for count, combination in enumerate(combinations):
+        if count % _CHUNK == 0 and time.time() >= deadline:
+            return wins, covered, False
+        weight = 1.0
+        totals = list(current)
+        for game, probs, outcome in zip(points, probabilities, combination):
+            weight *= probs[outcome]
+            totals = [total + int(pts) for total, pts in zip(totals, game[outcome])]
+        _add_wins(wins, totals, weight)
+        covered += weight
+    return wins, covered, True
+
+def _add_wins(wins, totals, weight):
+    """ Share the scenario weight between members with the highest total """
+    best = max(totals)
+    leaders = [idx for idx, total in enumerate(totals) if total == best]
+    for idx in leaders:
+        wins[idx] += weight / len(leaders)
+
+def _submit(workers, func, task_args):
+    """
+    Submit tasks to the process pool shared by projection requests. The pool
+    is created on first use with spawned processes, they do not inherit the
+    threads and database connections of the web process. Tasks are submitted
+    under the lock, so a pool replaced after a workers change is not used
+    any more, and its submitted tasks still complete.
+        Parameters:
+        - workers: process pool size
+        - func: task function
+        - task_args: list of argument tuples, one task each
+        Returns:
+        - list of futures
+    """
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ProcessPoolExecutor(max_workers=workers,
+                                            mp_context=multiprocessing.get_context("spawn"))
+            _executor_workers = workers
+        return [_executor.submit(func, *args) for args in task_args]
+
+def project(current, points, probabilities, samples, time_budget, workers=0, seed=None):
+    """
+    Win probabilities of members over the outcomes of the remaining games.
+    Outcomes are enumerated when there are at most `samples` combinations,
+    otherwise `samples` scenarios are sampled in `workers` processes
+    (0 = in this process). Enumeration gets half of the time budget: a
+    partial enumeration is biased (it walks the outcomes in order), so the
+    rest of the budget is used for sampling instead.
+        Parameters:
+        - current: current points of each member
+        - points: game_points() matrix for each remaining game
+        - probabilities: outcome probabilities for each remaining game
+        - samples: maximum number of scenarios
+        - time_budget: seconds, the result is partial if this runs out
+        - workers: process pool size
+        - seed: random seed for reproducible sampling
+        Returns:
+        - dictionary with "win_probability" list, "method", "scenarios"
+          and "complete" (False if time budget ran out)
+    """
+    deadline = time.time() + time_budget
+    if not current:
+        return {"win_probability": [], "method": "enumeration", "scenarios": 0, "complete": True}
+    combinations = 1
+    for probs in probabilities:
+        combinations *= len(probs)
+    if combinations <= samples:
+        wins, covered, complete = _enumerate(current, points, probabilities,
+                                             time.time() + time_budget / 2)
+        if complete:
+            return {"win_probability": [win / covered if covered else 0.0 for win in wins],
+                    "method": "enumeration",
+                    "scenarios": combinations,
+                    "complete": True}
+        time_budget = deadline - time.time()
+
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    if workers > 0:
+        futures = _submit(workers, _simulate,
+                          [(current, points, probabilities,
+                            samples // workers + (idx < samples % workers),
+                            seed + idx, deadline)
+                           for idx in range(workers)])
+        done, not_done = wait(futures, timeout=time_budget + 1.0)
+        for future in not_done:
+            future.cancel()
+        results = [future.result() for future in done]
+    else:
+        results = [_simulate(current, points, probabilities, samples, seed, deadline)]
+    wins = [0.0] * len(current)
+    sampled = 0
+    for result_wins, count in results:
+        wins = [total + win for total, win in zip(wins, result_wins)]
+        sampled += count
+    return {"win_probability": [win / sampled if sampled else 0.0 for win in wins],
+            "method": "sampling",
+            "scenarios": sampled,
+            "complete": sampled >= samples}
@@ -0,0 +1,122 @@
+"""
+In-process rank index of event members for O(log n) rank lookups.
+
+Point changes are queued in the database session by the scoring write
+paths and applied to the index only when the session commits, so a rolled
+back transaction never leaks into the ranks. The index is built for the
+event's response cache generation (see responsecache.py). A commit of this
+process moves the index to the generation it bumped to, when the index was
+up to date with the previous one, so local writes keep the index
+incremental. Any other generation change (a write of another process
+sharing the cache) rebuilds the index.
+"""
+from bisect import bisect_left, insort
+import threading
+
+from sqlalchemy import event as sa_event, func, select
+from sqlalchemy.orm import Session
+
+from sportbet import db, responsecache
+from sportbet.models import Member, Standing
+
+_SESSION_KEY = "rank_changes"
+_lock = threading.Lock()
+# (database URL, event id) -> RankIndex
+_indexes = {}
+
+class RankIndex:
+    """
+    Order-statistics index of member points in one event: a sorted array of
+    negated points answers rank queries with a binary search.
+    """
+    def __init__(self, rows, generation=None):
+        self.generation = generation
+        self.points = dict(rows)
+        self.keys = sorted(-points for points in self.points.values())
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rank(self, points):
+        """ Rank of the given points, members with equal points share the rank """
+        return bisect_left(self.keys, -points) + 1
+
+    def leader_points(self):
+        """ Highest points in the event """
+        return -self.keys[0] if self.keys else 0
+
+    def add(self, member_id, delta):
+        """ Add points to a member """
+        old = self.points.get(member_id)
+        if old is not None:
+            del self.keys[bisect_left(self.keys, -old)]
+        new = (old or 0) + delta
+        self.points[member_id] = new
+        insort(self.keys, -new)
+
+def member_rank(event, member, points):
+    """
+    Rank information of the member, the index is rebuilt if the event's
+    generation has changed or the index does not match the member's stored
+    points (e.g. changed by another process).
+        Parameters:
+        - event: Event object
+        - member: Member object
+        - points: member's stored points
+        Returns:
+        - (rank, member count, points of the leader)
+    """
+    key = _index_key(event)
+    # read before building, a change during the build gives a newer generation
+    generation = responsecache.generation(event.id)
+    with _lock:
+        index = _indexes.get(key)
+        if index is None or index.generation != generation or\
+           index.points.get(member.id) != points:
+            index = _indexes[key] = _build(event, generation)
+        return index.rank(points), len(index), index.leader_points()
+
+def _index_key(event):
+    return (str(db.engine.url), event.id)
+
+def _build(event, generation):
+    """ Build the index of the event from the Standing table """
+    stmt = select(Member.id, func.coalesce(Standing.points, 0))\
+        .outerjoin(Standing, Standing.member_id == Member.id)\
+        .where(Member.event_id == event.id)
+    return RankIndex(db.session.execute(stmt).all(), generation)
+
+def queue_change(event, deltas=None):
+    """
+    Queue point deltas {member_id: delta} to be applied on commit. Without
+    deltas the event's index is dropped on commit (members added or removed,
+    or points rebuilt).
+    """
+    db.session.info.setdefault(_SESSION_KEY, []).append((_index_key(event), deltas))
+
+# registered after the responsecache listener (imported above), which
+# stores the bumped generations of the commit in session.info
+@sa_event.listens_for(Session, "after_commit")
+def _apply_changes(session):
+    changes = session.info.pop(_SESSION_KEY, [])
+    bumps = session.info.pop(responsecache.BUMPS_SESSION_KEY, {})
+    with _lock:
+        for key, deltas in changes:
+            index = _indexes.get(key)
+            if index is None:
+                continue
+            if deltas is None:
+                del _indexes[key]
+                continue
+            for member_id, delta in deltas.items():
+                index.add(member_id, delta)
+        for key, index in _indexes.items():
+            if bumps and key[0] != str(db.engine.url):
+                continue
+            previous, generation = bumps.get(key[1], (None, None))
+            if generation is not None and index.generation == previous:
+                index.generation = generation
+
+@sa_event.listens_for(Session, "after_soft_rollback")
+def _discard_changes(session, previous_transaction):
+    session.info.pop(_SESSION_KEY, None)
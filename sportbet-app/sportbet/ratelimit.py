@@ -0,0 +1,112 @@
+"""
+Token-bucket rate limiting of API requests per API key and resource class.
+
+A bucket holds up to `limit` tokens and is refilled with `limit` tokens per
+minute, every request takes one token. Buckets live in process memory, or
+in a SQLite file (app config RATE_LIMIT_STORE) shared by the worker
+processes of one host.
+"""
+import math
+import sqlite3
+import threading
+import time
+
+from flask import current_app
+
+from sportbet import db
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+class MemoryBucketStore:
+    """ Buckets of this process """
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, bucket, limit, now):
+        """
+        Take a token from the bucket.
+            Parameters:
+            - bucket: bucket identifier string
+            - limit: bucket size and refill rate per minute
+            - now: current time in seconds
+            Returns:
+            - 0 if a token was taken, otherwise seconds until the next token
+        """
+        with self.lock:
+            tokens, updated = self.buckets.get(bucket, (limit, now))
+            tokens, wait = _refill(tokens, updated, limit, now)
+            self.buckets[bucket] = (tokens, now)
+            return wait
+
+class SqliteBucketStore:
+    """ Buckets in a SQLite file, shared by processes on the same host """
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS bucket "
+                         "(id TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def _connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=5.0,
+                                                     isolation_level=None)
+        return conn
+
+    def take(self, bucket, limit, now):
+        """ See MemoryBucketStore.take() """
+        conn = self._connect()
+        # write lock first, so that concurrent processes do not read the same tokens
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM bucket WHERE id = ?",
+                               (bucket,)).fetchone()
+            tokens, updated = row if row is not None else (limit, now)
+            tokens, wait = _refill(tokens, updated, limit, now)
+            conn.execute("INSERT OR REPLACE INTO bucket VALUES (?, ?, ?)",
+                         (bucket, tokens, now))
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+def _refill(tokens, updated, limit, now):
+    """ Refill the bucket and take a token, returns (tokens, wait seconds) """
+    tokens = min(float(limit), tokens + (now - updated) * limit / 60.0)
+    if tokens >= 1.0:
+        return tokens - 1.0, 0
+    return tokens, (1.0 - tokens) * 60.0 / limit
+
+def _get_store():
+    """ Bucket store of the app, created on first use """
+    path = current_app.config["RATE_LIMIT_STORE"]
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = SqliteBucketStore(path) if path else MemoryBucketStore()
+        return store
+
+def check(api_key, resource):
+    """
+    Take a token from the bucket of the API key and resource class. The limit
+    is the key's rate_limit (app config RATE_LIMIT if not set), capped by the
+    resource class attribute RATE_LIMIT.
+        Parameters:
+        - api_key: keycache.CachedKey of the request
+        - resource: Resource object serving the request
+        Returns:
+        - 0 if the request is allowed, otherwise Retry-After seconds
+    """
+    limit = api_key.rate_limit or current_app.config["RATE_LIMIT"]
+    resource_limit = getattr(resource, "RATE_LIMIT", None)
+    if resource_limit:
+        limit = min(limit, resource_limit) if limit else resource_limit
+    if not limit:
+        return 0
+    bucket = str(db.engine.url) + "|" + api_key.key.hex() + "|" + type(resource).__name__
+    wait = _get_store().take(bucket, limit, time.time())
+    return math.ceil(wait)
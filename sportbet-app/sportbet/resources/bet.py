@@ -2,22 +2,51 @@
 Resource classes to serve API-requests related to game bets.
 """
 import json
-from jsonschema import validate, ValidationError
-from flask import Response, request, url_for
+from jsonschema import ValidationError
+from flask import Response, current_app, request, url_for
 from flask_restful import Resource
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import contains_eager, joinedload
 
-from sportbet import db
-from sportbet.models import Game, Bet
-from sportbet.constants import SPORTBET_NAMESPACE, BET_PROFILE, MASON
+from sportbet import db, stats
+from sportbet.models import Game, Member, Bet
+from sportbet.scoring import apply_bet_change, apply_bet_changes
+from sportbet.constants import SPORTBET_NAMESPACE, BET_PROFILE, JSON, MASON, MASON_COMPACT
 from sportbet.utils import SportbetBuilder, error_response, validate_api_key,\
-                           debug_print, not_json_request
+                           debug_print, not_json_request, validate_json,\
+                           compact_request, compact_fields, compact_args,\
+                           page_parameters, page_size, page_links, keyset_page
+from sportbet.serializer import render_item, shared_control, sparse_item,\
+                                stream_response
+from sportbet.responsecache import cached_response, conditional_response, queue_bump
+
+# insert constructs of the database backends with ON CONFLICT DO UPDATE upserts
+UPSERT_INSERTS = {"sqlite": sqlite_insert, "postgresql": postgresql_insert}
 
 class BetsAll(Resource):
     """ Resource listing bets in the event or given game. """
     
     @validate_api_key
+    @conditional_response
+    @cached_response
     def get(self, event, game=None):
-        """ Get list of all bets in the event. """
+        """
+        Get list of all bets in the event, ordered by game number and
+        nickname. Query parameters limit and cursor page the bets.
+        """
+        try:
+            limit, direction, key = page_parameters((str, str))
+        except ValueError as exception:
+            return error_response(400, "Invalid query parameter", str(exception))
+        # one query: game filter (ix_bet_game_id) in SQL, games and members loaded with the bets
+        query = Bet.query.join(Bet.game).join(Bet.member).filter(Game.event_id == event.id)\
+                   .options(contains_eager(Bet.game), contains_eager(Bet.member))
+        if game is not None:
+            query = query.filter(Bet.game_id == game.id)
+        bets, more = keyset_page(query, [Game.game_nbr, Member.nickname], page_size(limit),
+                                 direction, key)
         body = SportbetBuilder()
         body.add_namespace(SPORTBET_NAMESPACE)
         body.add_control("self",
@@ -30,23 +59,49 @@ class BetsAll(Resource):
             body.add_control_all_bets(event)
         else:
             body.add_control_betting_status(event, None)
-        bets = Bet.query.join(Bet.game).filter_by(event=event).order_by(Game.game_nbr)
-        body["items"] = []
-        for bet in bets:
-            if game is not None:
-                if bet.game != game:
+        if bets:
+            body.add_control_pages("api.betsall",
+                                   dict(compact_args(), event=event, game=game),
+                                   limit, page_links(direction, key, more),
+                                   [bets[0].game.game_nbr, bets[0].member.nickname],
+                                   [bets[-1].game.game_nbr, bets[-1].member.nickname])
+        compact = compact_request()
+        if compact:
+            # teams and results are in the game table, not in every bet
+            try:
+                fields = compact_fields(["nickname", "game_nbr", "home_goals", "guest_goals"])
+            except ValueError as exception:
+                return error_response(400, "Invalid query parameter", str(exception))
+            body.add_control("profile", BET_PROFILE, title="Bet profile")
+            body.add_game_table(bet.game for bet in bets)
+        profile = shared_control("profile", BET_PROFILE, "Bet profile")
+        def items():
+            for bet in bets:
+                if compact:
+                    yield render_item(sparse_item(bet.serialize(), fields))
                     continue
-            item = SportbetBuilder(bet.serialize())
-            item.add_control("profile", BET_PROFILE, title="Bet profile")
-            body["items"].append(item)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+                yield render_item(bet.serialize(), profile)
+        return stream_response(body, items(), MASON_COMPACT if compact else MASON)
 
 class BetsMember(Resource):
     """ Resource listing bets for the given member. """
     
     @validate_api_key
+    @conditional_response
+    @cached_response
     def get(self, event, member):
-        """ Get list of the given member's bets in the event. """
+        """
+        Get list of the given member's bets in the event, ordered by game
+        number. Query parameters limit and cursor page the bets.
+        """
+        try:
+            limit, direction, key = page_parameters((str,))
+        except ValueError as exception:
+            return error_response(400, "Invalid query parameter", str(exception))
+        # bets are rendered while streaming, all they refer to is loaded here
+        query = Bet.query.filter_by(member=member).join(Bet.game)\
+                   .options(contains_eager(Bet.game), joinedload(Bet.member))
+        bets, more = keyset_page(query, [Game.game_nbr], page_size(limit), direction, key)
         body = SportbetBuilder()
         body.add_namespace(SPORTBET_NAMESPACE)
         body.add_control("self",
@@ -55,13 +110,30 @@ class BetsMember(Resource):
         body.add_control_all_bets(event)
         body.add_control_add_bet(event, member)
         body.add_control_edit_bet(event, member)
-        bets = Bet.query.filter_by(member=member).join(Bet.game).order_by(Game.game_nbr).all()
-        body["items"] = []
-        for bet in bets:
-            item = SportbetBuilder(bet.serialize())
-            item.add_control("profile", BET_PROFILE, title="Bet profile")
-            body["items"].append(item)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        body.add_control_add_bets(event, member)
+        if bets:
+            body.add_control_pages("api.betsmember",
+                                   dict(compact_args(), event=event, member=member),
+                                   limit, page_links(direction, key, more),
+                                   [bets[0].game.game_nbr], [bets[-1].game.game_nbr])
+        compact = compact_request()
+        if compact:
+            # the member's nickname only once, teams and results in the game table
+            try:
+                fields = compact_fields(["game_nbr", "home_goals", "guest_goals"])
+            except ValueError as exception:
+                return error_response(400, "Invalid query parameter", str(exception))
+            body.add_control("profile", BET_PROFILE, title="Bet profile")
+            body["nickname"] = member.nickname
+            body.add_game_table(bet.game for bet in bets)
+        profile = shared_control("profile", BET_PROFILE, "Bet profile")
+        def items():
+            for bet in bets:
+                if compact:
+                    yield render_item(sparse_item(bet.serialize(), fields))
+                    continue
+                yield render_item(bet.serialize(), profile)
+        return stream_response(body, items(), MASON_COMPACT if compact else MASON)
 
     @validate_api_key
     def post(self, event, member):
@@ -69,7 +141,7 @@ class BetsMember(Resource):
         if not_json_request(request):
             return error_response(415, "Unsupported media type", "JSON required")
         try:
-            validate(request.json, Bet.json_schema(full_format=False))
+            validate_json(request.json, Bet, full_format=False)
             bet = Bet()
             bet.deserialize(request.json)
             if bet.home_goals < 0 or bet.guest_goals < 0:
@@ -85,6 +157,9 @@ class BetsMember(Resource):
             bet.member = member
             bet.game = game
             db.session.add(bet)
+            apply_bet_change(event, member, game, None, (bet.home_goals, bet.guest_goals))
+            stats.queue_invalidation([game.id])
+            queue_bump(event)
             db.session.commit()
             debug_print(event.name + "/Game-" + game.game_nbr + "/" + member.nickname +\
                         "/" + game.home_team + "-" + game.guest_team + " " +\
@@ -101,7 +176,7 @@ class BetsMember(Resource):
         if not_json_request(request):
             return error_response(415, "Unsupported media type", "JSON required")
         try:
-            validate(request.json, Bet.json_schema(full_format=False))
+            validate_json(request.json, Bet, full_format=False)
             request_bet = Bet()
             request_bet.deserialize(request.json)
             if request_bet.home_goals < 0 or request_bet.guest_goals < 0:
@@ -112,8 +187,12 @@ class BetsMember(Resource):
             bet = Bet.query.filter_by(game=game, member=member).first()
             if not bet:
                 return error_response(404, "Bet not found")
+            old_bet = (bet.home_goals, bet.guest_goals)
             bet.home_goals = request_bet.home_goals
             bet.guest_goals = request_bet.guest_goals
+            apply_bet_change(event, member, game, old_bet, (bet.home_goals, bet.guest_goals))
+            stats.queue_invalidation([game.id])
+            queue_bump(event)
             db.session.commit()
             debug_print(event.name + "/Game-" + game.game_nbr + "/" +\
                         member.nickname + "/" + game.home_team + "-" +\
@@ -124,3 +203,92 @@ class BetsMember(Resource):
         except ValidationError as exception:
             # handles also KeyError and ValueError
             return error_response(400, "Invalid JSON document", str(exception))
+
+class BetsBatch(Resource):
+    """ Resource for adding and updating many bets of the given member at once. """
+
+    @validate_api_key
+    def post(self, event, member):
+        """
+        Add or update the given member's bets in one transaction. The body is
+        a list of bets, the response lists the status of each: 201 added,
+        204 updated, 400 invalid bet, 404 game not found or 409 game repeated
+        in the batch. Bets with an error status are not saved.
+        """
+        insert = UPSERT_INSERTS.get(db.engine.dialect.name)
+        if insert is None:
+            return error_response(501, "Not implemented",
+                                  "Bet batches are not supported with " +\
+                                  db.engine.dialect.name + " databases")
+        # an empty list is a valid batch, not_json_request() would reject it
+        if request.mimetype != JSON:
+            return error_response(415, "Unsupported media type", "JSON required")
+        bets = request.get_json(silent=True)
+        if not isinstance(bets, list):
+            return error_response(400, "Invalid JSON document", "List of bets required")
+        if len(bets) > current_app.config["BET_BATCH_MAX_SIZE"]:
+            return error_response(400, "Too many bets",
+                                  "At most " + str(current_app.config["BET_BATCH_MAX_SIZE"]) +\
+                                  " bets in a batch")
+        # validate everything first, then read the games and old bets in one query each
+        results = []
+        valid = {}
+        for item in bets:
+            game_nbr = item.get("game_nbr") if isinstance(item, dict) else None
+            try:
+                validate_json(item, Bet, full_format=False)
+                if item["home_goals"] < 0 or item["guest_goals"] < 0:
+                    raise ValidationError("Bet goals must not be negative")
+            except ValidationError as exception:
+                results.append({"game_nbr": game_nbr, "status": 400,
+                                "message": exception.message})
+                continue
+            if game_nbr in valid:
+                results.append({"game_nbr": game_nbr, "status": 409,
+                                "message": "Game repeated in the batch"})
+                continue
+            valid[game_nbr] = (item["home_goals"], item["guest_goals"])
+            results.append({"game_nbr": game_nbr, "status": None})
+        games = {game.game_nbr: game for game in
+                 Game.query.filter(Game.event_id == event.id, Game.game_nbr.in_(list(valid)))}
+        old_bets = {row.game_id: (row.home_goals, row.guest_goals) for row in
+                    db.session.execute(select(Bet.game_id, Bet.home_goals, Bet.guest_goals)
+                                       .where(Bet.member_id == member.id,
+                                              Bet.game_id.in_([game.id for game
+                                                               in games.values()])))}
+        rows = []
+        changes = []
+        for result in results:
+            if result["status"] is not None:
+                continue
+            game = games.get(result["game_nbr"])
+            if game is None:
+                result.update(status=404, message="Game not found")
+                continue
+            new_bet = valid[game.game_nbr]
+            old_bet = old_bets.get(game.id)
+            result["status"] = 201 if old_bet is None else 204
+            rows.append({"member_id": member.id, "game_id": game.id,
+                         "home_goals": new_bet[0], "guest_goals": new_bet[1]})
+            changes.append((game, old_bet, new_bet))
+        if rows:
+            # upsert on the (member_id, game_id) unique constraint, executemany
+            stmt = insert(Bet.__table__)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["member_id", "game_id"],
+                set_={"home_goals": stmt.excluded.home_goals,
+                      "guest_goals": stmt.excluded.guest_goals})
+            db.session.execute(stmt, rows)
+            apply_bet_changes(event, member, changes)
+            stats.queue_invalidation([game.id for game, old_bet, new_bet in changes])
+            queue_bump(event)
+            db.session.commit()
+            debug_print(event.name + "/" + member.nickname + " " +\
+                        str(len(rows)) + " bets added or updated")
+        body = SportbetBuilder()
+        body.add_namespace(SPORTBET_NAMESPACE)
+        body.add_control("self", url_for("api.betsbatch", event=event, member=member),
+                         title="This resource")
+        body.add_control_member_bets(event, member)
+        body["items"] = results
+        return Response(json.dumps(body), 200, mimetype=MASON)
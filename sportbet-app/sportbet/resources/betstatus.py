@@ -2,87 +2,210 @@
 Resource class to serve API-requests related to betting status.
 """
 import json
-from flask import Response, url_for
+from flask import Response, current_app, request, url_for
 from flask_restful import Resource
+from sqlalchemy import select
 
-from sportbet.models import Game
+from sportbet import db, projection, ranking
+from sportbet.models import Game, Bet
+from sportbet.scoring import standings, standings_page, snapshot_standings,\
+                             member_points, rules_for
 from sportbet.constants import SPORTBET_NAMESPACE, BETSTATUS_PROFILE, MASON
-from sportbet.utils import SportbetBuilder, validate_api_key, debug_print
-
-# calculate points for the given bet
-def _betpoints(event, bet):
-    game = Game.query.filter_by(event=event, game_nbr=bet.game.game_nbr).first()
-    points = 0
-    # Game not played yet
-    if game.home_goals < 0:
-        points = 0
-    # Exactly correct result
-    elif (bet.home_goals == game.home_goals) and (bet.guest_goals == game.guest_goals):
-        points = 3
-    # Goal difference correct (also event result)
-    elif (bet.home_goals-bet.guest_goals) == (game.home_goals-game.guest_goals):
-        points = 2
-    # Winner correct
-    elif game.home_goals>game.guest_goals and bet.home_goals>bet.guest_goals:
-        points = 1
-    elif game.home_goals<game.guest_goals and bet.home_goals<bet.guest_goals:
-        points = 1
-    return points
+from sportbet.utils import SportbetBuilder, validate_api_key, debug_print,\
+                           error_response, query_parameter, page_parameters,\
+                           page_size, page_links
+from sportbet.serializer import CollectionSerializer, item_control
+from sportbet.urltemplates import href
+from sportbet.responsecache import cached_response, conditional_response
 
 class BetStatus(Resource):
     """ Resource class to build betting status (member ranking). """
     @validate_api_key
+    @conditional_response
+    @cached_response
     def get(self, event, member=None):
         """
         Get betting status of the event.
         Return members and their points ordered by total points (highest first).
+        Query parameter after_game=<game_nbr> returns the stored betting status
+        right after the given game's result was set. Query parameters limit and
+        cursor page the members with keyset pagination on (points, nickname).
         If member parameter is given, only bets for this member with detailed
-        information are returned.
+        information are returned, together with the member's total points,
+        rank (equal points share the rank) and gap to the leader.
         """
+        after_game = request.args.get("after_game") if member is None else None
+        limit, direction, key = None, "next", None
+        rows, more = [], False
+        if member is None:
+            try:
+                limit, direction, key = page_parameters((int, str))
+            except ValueError as exception:
+                return error_response(400, "Invalid query parameter", str(exception))
+        if after_game is not None:
+            rows = snapshot_standings(event, after_game)
+            if rows is None:
+                return error_response(404, "Betting status snapshot not found",
+                                      "Game " + after_game + " not found or result not set")
+            rows, more = _page_list(rows, page_size(limit), direction, key)
+        elif member is None:
+            rows, more = standings_page(event, page_size(limit), direction, key)
         body = SportbetBuilder()
         body.add_namespace(SPORTBET_NAMESPACE)
         body.add_control("self",
                          url_for("api.betstatus",
                                  event=event,
-                                 member=member),
+                                 member=member,
+                                 after_game=after_game,
+                                 limit=limit,
+                                 cursor=request.args.get("cursor") if member is None else None),
                                  title="This resource")
         body.add_control("profile", BETSTATUS_PROFILE, title="BetStatus profile")
         body.add_control_single_event(event)
-        body["items"] = []
-        for mem in event.members:
-            # Show only wanted member's bets
-            if member is not None and mem != member:
-                continue
-            points = 0
-            # Calculate points for all member's bets
-            for bet in mem.bets:
-                pts = _betpoints(event, bet)
-                if member is not None:
-                    debug_print(member.nickname + " game-" + bet.game.game_nbr + " = " + str(pts))
-                    # Detailed information for the given member
-                    item = SportbetBuilder({"game_nbr": bet.game.game_nbr,
-                                            "points": pts,
-                                            "result": str(bet.game.home_goals) +\
-                                            "-" + str(bet.game.guest_goals),
-                                            "bet": str(bet.home_goals) + "-" + str(bet.guest_goals)
-                                            })
-                    body["items"].append(item)
-                points += pts
-            # Only nicknames and points for all members
-            if member is None:
+        if member is None:
+            body.add_control_projection(event)
+        if after_game is not None:
+            body["after_game"] = after_game
+            body.add_control_betting_status(event, None)
+        if member is not None:
+            points = member.standing.points if member.standing is not None else 0
+            rank, member_count, leader_points = ranking.member_rank(event, member, points)
+            body["nickname"] = member.nickname
+            body["points"] = points
+            body["rank"] = rank
+            body["members"] = member_count
+            body["gap_to_leader"] = leader_points - points
+        # Only nicknames and points for all members, highest points first
+        if member is None:
+            if rows:
+                body.add_control_pages("api.betstatus",
+                                       {"event": event, "after_game": after_game},
+                                       limit, page_links(direction, key, more),
+                                       [rows[0][1], rows[0][0].nickname],
+                                       [rows[-1][1], rows[-1][0].nickname])
+            out = CollectionSerializer(body)
+            for mem, points in rows:
                 debug_print(mem.nickname + " = " + str(points) + " points")
-                item = SportbetBuilder({"nickname": mem.nickname, "points": points})
-                # item.add_control_betting_status(event, mem)
-                item.add_control("self",
-                                 url_for("api.betstatus", event=event, member=mem),
-                                 title=mem.nickname + " bet status")
+                out.add_item({"nickname": mem.nickname, "points": points},
+                             item_control("self",
+                                          href("api.betstatus", event=event, member=mem),
+                                          mem.nickname + " bet status"))
+            return Response(out.render(), 200, mimetype=MASON)
+        # Detailed information for the given member, ordered by game number
+        else:
+            body["items"] = []
+            for row in member_points(event, member):
+                debug_print(member.nickname + " game-" + row.game_nbr + " = " + str(row.points))
+                item = SportbetBuilder({"game_nbr": row.game_nbr,
+                                        "points": row.points,
+                                        "result": str(row.game_home) +\
+                                        "-" + str(row.game_guest),
+                                        "bet": str(row.bet_home) + "-" + str(row.bet_guest)
+                                        })
                 body["items"].append(item)
-            else:
-                body.add_control_betting_status(event, None)
-        # Order to have highest points member first
-        if member is None:
-            body["items"] = sorted(body["items"], key=lambda d: d['points'], reverse=True)
-        # Order according to game number
+            body.add_control_betting_status(event, None)
+        return Response(json.dumps(body), 200, mimetype=MASON)
+
+def _page_list(rows, limit, direction, key):
+    """ Keyset page of a (Member, points) list sorted by points and nickname """
+    if key is not None:
+        boundary = (-key[0], key[1])
+        if direction == "next":
+            rows = [row for row in rows if (-row[1], row[0].nickname) > boundary]
         else:
-            body["items"] = sorted(body["items"], key=lambda d: d['game_nbr'])
+            rows = [row for row in rows if (-row[1], row[0].nickname) < boundary]
+    if limit is None or len(rows) <= limit:
+        return rows, False
+    if direction == "next":
+        return rows[:limit], True
+    return rows[-limit:], True
+
+class BetStatusProjection(Resource):
+    """
+    Resource class to project the betting status over the games not played
+    yet: maximum reachable points and win probability of each member.
+    """
+    # Requests per minute per API key, projections are expensive
+    RATE_LIMIT = 30
+    @validate_api_key
+    @conditional_response
+    def get(self, event):
+        """
+        Get projected betting status of the event. Query parameters (defaults
+        from app config PROJECTION_*):
+         - samples: maximum number of simulated scenarios
+         - time_budget: maximum calculation time in seconds
+         - distribution: goal distribution "poisson" or "uniform"
+         - home_goals, guest_goals: expected goals for poisson distribution
+         - max_goals: highest goal count of a team in simulated results
+         - seed: random seed for reproducible sampling
+        """
+        config = current_app.config
+        try:
+            samples = query_parameter("samples", config["PROJECTION_SAMPLES"], int,
+                                      1, config["PROJECTION_MAX_SAMPLES"])
+            time_budget = query_parameter("time_budget", config["PROJECTION_TIME_BUDGET"],
+                                          float, 0.0, config["PROJECTION_MAX_TIME_BUDGET"])
+            distribution = query_parameter("distribution", config["PROJECTION_DISTRIBUTION"], str)
+            if distribution not in ("poisson", "uniform"):
+                raise ValueError("Query parameter distribution must be poisson or uniform")
+            home_mean = query_parameter("home_goals", config["PROJECTION_HOME_GOALS"],
+                                        float, 0.0, 20.0)
+            guest_mean = query_parameter("guest_goals", config["PROJECTION_GUEST_GOALS"],
+                                         float, 0.0, 20.0)
+            max_goals = query_parameter("max_goals", config["PROJECTION_MAX_GOALS"], int, 0, 20)
+            seed = query_parameter("seed", None, int, 0)
+        except ValueError as exception:
+            return error_response(400, "Invalid query parameter", str(exception))
+
+        rules = rules_for(event)
+        members = standings(event)
+        member_index = {mem.id: idx for idx, (mem, _) in enumerate(members)}
+        current = [points for _, points in members]
+        max_points = list(current)
+        games = Game.query.filter(Game.event_id == event.id, Game.home_goals < 0).all()
+        game_bets = {game.id: [] for game in games}
+        stmt = select(Bet.game_id, Bet.member_id, Bet.home_goals, Bet.guest_goals)\
+            .where(Bet.game_id.in_(game_bets.keys()))
+        for game_id, member_id, bet_home, bet_guest in db.session.execute(stmt):
+            idx = member_index[member_id]
+            game_bets[game_id].append((idx, bet_home, bet_guest))
+            max_points[idx] += projection.max_bet_points(rules, bet_home, bet_guest)
+
+        outcomes = projection.game_outcomes(
+            projection.goal_probabilities(distribution, home_mean, max_goals),
+            projection.goal_probabilities(distribution, guest_mean, max_goals))
+        probabilities = [probability for _, probability in outcomes]
+        points = [projection.game_points(rules, outcomes, game_bets[game.id], len(members))
+                  for game in games]
+        result = projection.project(current, points, [probabilities] * len(games),
+                                    samples, time_budget, config["PROJECTION_WORKERS"], seed)
+        debug_print(event.name + " projection: " + result["method"] + " " +\
+                    str(result["scenarios"]) + " scenarios")
+
+        body = SportbetBuilder()
+        body.add_namespace(SPORTBET_NAMESPACE)
+        body.add_control("self",
+                         url_for("api.betstatusprojection", event=event),
+                         title="This resource")
+        body.add_control("profile", BETSTATUS_PROFILE, title="BetStatus profile")
+        body.add_control_single_event(event)
+        body.add_control_betting_status(event, None)
+        body["remaining_games"] = len(games)
+        body["method"] = result["method"]
+        body["scenarios"] = result["scenarios"]
+        body["complete"] = result["complete"]
+        body["items"] = []
+        for (mem, points), max_pts, probability in zip(members, max_points,
+                                                       result["win_probability"]):
+            item = SportbetBuilder({"nickname": mem.nickname,
+                                    "points": points,
+                                    "max_points": max_pts,
+                                    "win_probability": round(probability, 4)})
+            item.add_control("self",
+                             url_for("api.betstatus", event=event, member=mem),
+                             title=mem.nickname + " bet status")
+            body["items"].append(item)
+        # Most probable winner first
+        body["items"] = sorted(body["items"], key=lambda d: d["win_probability"], reverse=True)
         return Response(json.dumps(body), 200, mimetype=MASON)
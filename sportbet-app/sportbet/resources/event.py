@@ -7,31 +7,47 @@ from flask_restful import Resource
 
 from sportbet.models import Event
 from sportbet.constants import SPORTBET_NAMESPACE, EVENT_PROFILE, MASON
-from sportbet.utils import SportbetBuilder, validate_api_key
+from sportbet.utils import SportbetBuilder, validate_api_key, error_response,\
+                           page_parameters, page_size, page_links, keyset_page
+from sportbet.serializer import CollectionSerializer, item_control, shared_control
+from sportbet.urltemplates import href
+from sportbet.responsecache import cached_response, conditional_response
 
 class EventCollection(Resource):
     """ Resource class to list events in the system. """
     @validate_api_key
+    @conditional_response
+    @cached_response
     def get(self):
         """
         Get list of events in the system.
-        Events are returned in body["items"] list.
+        Events are returned in body["items"] list, ordered by name. Query
+        parameters limit and cursor page the events.
         """
+        try:
+            limit, direction, key = page_parameters((str,))
+        except ValueError as exception:
+            return error_response(400, "Invalid query parameter", str(exception))
+        events, more = keyset_page(Event.query, [Event.name], page_size(limit), direction, key)
         body = SportbetBuilder()
         body.add_namespace(SPORTBET_NAMESPACE)
         body.add_control("self", url_for("api.eventcollection"), title="All events")
-        events = Event.query.all()
-        body["items"] = []
+        if events:
+            body.add_control_pages("api.eventcollection", {}, limit,
+                                   page_links(direction, key, more),
+                                   [events[0].name], [events[-1].name])
+        out = CollectionSerializer(body)
+        profile = shared_control("profile", EVENT_PROFILE, "Event profile")
         for event in events:
-            item = SportbetBuilder(event.serialize())
-            item.add_control("self", url_for("api.eventitem", event=event), title=event.name)
-            item.add_control("profile", EVENT_PROFILE, title="Event profile")
-            body["items"].append(item)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+            out.add_item(event.serialize(),
+                         item_control("self", href("api.eventitem", event=event), event.name),
+                         profile)
+        return Response(out.render(), 200, mimetype=MASON)
 
 class EventItem(Resource):
     """ Resource class to get given event in the system. """
     @validate_api_key
+    @conditional_response
     def get(self, event):
         """ Get given event in the system. """
         body = SportbetBuilder(event.serialize())
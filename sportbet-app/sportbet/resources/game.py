@@ -2,36 +2,72 @@
 Resource classes to serve API-requests related to games.
 """
 import json
-from jsonschema import validate, ValidationError
-from flask import Response, request, url_for
+from jsonschema import ValidationError
+from flask import Response, current_app, request, url_for
 from flask_restful import Resource
 
-from sportbet import db
+from sportbet import db, stats
 from sportbet.models import Game
-from sportbet.constants import SPORTBET_NAMESPACE, GAME_PROFILE, MASON
+from sportbet.scoring import apply_result_change, apply_result_changes
+from sportbet.constants import SPORTBET_NAMESPACE, GAME_PROFILE, JSON, MASON, MASON_COMPACT
 from sportbet.utils import SportbetBuilder, error_response, validate_api_key,\
-                           debug_print, not_json_request
+                           require_admin_key,\
+                           debug_print, not_json_request, validate_json,\
+                           compact_request, compact_fields, compact_args,\
+                           page_parameters, page_size, page_links, keyset_page
+from sportbet.serializer import item_control, render_item, shared_control,\
+                                sparse_item, stream_response
+from sportbet.urltemplates import href, item_template
+from sportbet.responsecache import cached_response, conditional_response, queue_bump
 
 class GameCollection(Resource):
     """ Resource class for listing games in the event and adding new event. """
     @validate_api_key
+    @conditional_response
+    @cached_response
     def get(self, event):
-        """ Get games in given event. """
+        """
+        Get games in given event, ordered by game number. Query parameters
+        limit and cursor page the games.
+        """
+        try:
+            limit, direction, key = page_parameters((str,))
+        except ValueError as exception:
+            return error_response(400, "Invalid query parameter", str(exception))
+        games, more = keyset_page(Game.query.filter_by(event_id=event.id),
+                                  [Game.game_nbr], page_size(limit), direction, key)
         body = SportbetBuilder()
         body.add_namespace(SPORTBET_NAMESPACE)
         body.add_control("self", url_for("api.gamecollection", event=event), title="This resource")
         body.add_control_single_event(event)
         body.add_control_add_game(event)
-        body["items"] = []
-        for game in event.games:
-            item = SportbetBuilder(game.serialize())
-            item.add_control("self",
-                             url_for("api.gameitem", event=event, game=game),
-                             title="Game #" + game.game_nbr + " " +\
-                             game.home_team + " - " + game.guest_team)
-            item.add_control("profile", GAME_PROFILE, title="Game profile")
-            body["items"].append(item)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        if games:
+            body.add_control_pages("api.gamecollection", dict(compact_args(), event=event),
+                                   limit, page_links(direction, key, more),
+                                   [games[0].game_nbr], [games[-1].game_nbr])
+        compact = compact_request()
+        if compact:
+            try:
+                fields = compact_fields(["game_nbr", "home_team", "guest_team",
+                                         "home_goals", "guest_goals"])
+            except ValueError as exception:
+                return error_response(400, "Invalid query parameter", str(exception))
+            body.add_control("profile", GAME_PROFILE, title="Game profile")
+            body.add_control_item_template(item_template("api.gameitem", "game",
+                                                         event=event), "Game")
+        profile = shared_control("profile", GAME_PROFILE, "Game profile")
+        def items():
+            for game in games:
+                if compact:
+                    yield render_item(sparse_item(game.serialize(), fields))
+                    continue
+                yield render_item(game.serialize(),
+                                  item_control("self",
+                                               href("api.gameitem", event=event, game=game),
+                                               "Game #" + game.game_nbr + " " +\
+                                               game.home_team + " - " + game.guest_team),
+                                  profile)
+        return stream_response(body, items(), MASON_COMPACT if compact else MASON)
 
     @validate_api_key
     def post(self, event):
@@ -42,13 +78,14 @@ class GameCollection(Resource):
         if not_json_request(request):
             return error_response(415, "Unsupported media type", "JSON required")
         try:
-            validate(request.json, Game.json_schema(only_goals=False))
+            validate_json(request.json, Game, only_goals=False)
             request_game = Game()
             request_game.deserialize(request.json, full_format=True)
             game = Game.query.filter_by(event=event, game_nbr=request_game.game_nbr).first()
             if game:
                 return error_response(409, "Game with given number/name already exists")
             event.games.append(request_game)
+            queue_bump(event)
             db.session.commit()
             debug_print(event.name + "/Game-" + request_game.game_nbr +\
                         " " + str(request_game) + "-" + str(request_game.guest_goals) + " added")
@@ -61,6 +98,7 @@ class GameCollection(Resource):
 class GameItem(Resource):
     """ Resource class for getting, updating and deleting the given game. """
     @validate_api_key
+    @conditional_response
     def get(self, event, game):
         """ Get the given game in the given event. """
         body = SportbetBuilder(game.serialize())
@@ -71,6 +109,7 @@ class GameItem(Resource):
         body.add_control("profile", GAME_PROFILE, title="Game profile")
         body.add_control_all_games(event)
         body.add_control_game_bets(event, game)
+        body.add_control_game_stats(event, game)
         body.add_control_edit_result(event, game)
         body.add_control_delete_game(event, game)
         return Response(json.dumps(body), 200, mimetype=MASON)
@@ -81,8 +120,11 @@ class GameItem(Resource):
         if not_json_request(request):
             return error_response(415, "Unsupported media type", "JSON required")
         try:
-            validate(request.json, Game.json_schema(only_goals=True))
+            validate_json(request.json, Game, only_goals=True)
+            old_result = (game.home_goals, game.guest_goals)
             game.deserialize(request.json, full_format=False)
+            apply_result_change(event, game, old_result, (game.home_goals, game.guest_goals))
+            queue_bump(event)
             db.session.commit()
             debug_print(event.name + "/Game-" + game.game_nbr +\
                         " result " + str(game.home_goals) + "-" +\
@@ -96,8 +138,81 @@ class GameItem(Resource):
     @validate_api_key
     def delete(self, event, game):
         """ Delete game in the event. """
+        # deleted bets lose their points as if the result was reset
+        apply_result_change(event, game, (game.home_goals, game.guest_goals), (-1, -1))
+        stats.queue_invalidation([game.id])
+        queue_bump(event)
         db.session.delete(game)
         db.session.commit()
         debug_print(event.name + "/Game-" + game.game_nbr + " deleted")
         return Response(status=204,
                         headers={"Location": url_for("api.gamecollection", event=event)})
+
+class GameStats(Resource):
+    """ Resource class for the bet distribution statistics of the given game. """
+    @validate_api_key
+    @conditional_response
+    def get(self, event, game):
+        """
+        Get statistics of the bets for the given game: number of predicted
+        home wins, draws and away wins, most common exact scores and average
+        predicted goals.
+        """
+        body = SportbetBuilder(stats.game_stats(game))
+        body.add_namespace(SPORTBET_NAMESPACE)
+        body.add_control("self",
+                         url_for("api.gamestats", event=event, game=game),
+                         title="This resource")
+        body.add_control("profile", GAME_PROFILE, title="Game profile")
+        body.add_control_single_game(event, game)
+        body.add_control_game_bets(event, game)
+        body["game_nbr"] = game.game_nbr
+        return Response(json.dumps(body), 200, mimetype=MASON)
+
+class GameResults(Resource):
+    """ Resource class for setting many game results of the event at once (admin). """
+    @require_admin_key
+    def put(self, event):
+        """
+        Save the given game results in one transaction: all of them or, if
+        any result is invalid or its game is not found, none of them. The
+        betting status is updated once for the whole batch.
+        """
+        if request.mimetype != JSON:
+            return error_response(415, "Unsupported media type", "JSON required")
+        results = request.get_json(silent=True)
+        if not isinstance(results, list):
+            return error_response(400, "Invalid JSON document", "List of game results required")
+        if len(results) > current_app.config["RESULT_BATCH_MAX_SIZE"]:
+            return error_response(400, "Too many results",
+                                  "At most " + str(current_app.config["RESULT_BATCH_MAX_SIZE"]) +\
+                                  " results in a batch")
+        new_results = {}
+        for item in results:
+            try:
+                validate_json(item, Game, only_goals=True)
+                if not isinstance(item.get("game_nbr"), str):
+                    raise ValidationError("'game_nbr' string is required")
+            except ValidationError as exception:
+                return error_response(400, "Invalid JSON document", exception.message)
+            if item["game_nbr"] in new_results:
+                return error_response(409, "Game repeated in the batch", item["game_nbr"])
+            new_results[item["game_nbr"]] = (item["home_goals"], item["guest_goals"])
+        games = {game.game_nbr: game for game in
+                 Game.query.filter(Game.event_id == event.id,
+                                   Game.game_nbr.in_(list(new_results)))}
+        missing = [game_nbr for game_nbr in new_results if game_nbr not in games]
+        if missing:
+            return error_response(404, "Game not found", ", ".join(missing))
+        # results in the request order, it is the order of the snapshots
+        changes = []
+        for game_nbr, new_result in new_results.items():
+            game = games[game_nbr]
+            changes.append((game, (game.home_goals, game.guest_goals), new_result))
+            game.home_goals, game.guest_goals = new_result
+        apply_result_changes(event, changes)
+        queue_bump(event)
+        db.session.commit()
+        debug_print(event.name + " " + str(len(changes)) + " game results saved")
+        hdrs = {"Location": url_for("api.gamecollection", event=event)}
+        return Response(status=204, headers=hdrs)
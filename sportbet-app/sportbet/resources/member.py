@@ -2,26 +2,42 @@
 Resource classes for handling event members.
 """
 import json
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import Response, request, url_for
 from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
 
-from sportbet import db
-from sportbet.models import Member
-from sportbet.constants import SPORTBET_NAMESPACE, MEMBER_PROFILE, MASON
+from sportbet import db, ranking, stats
+from sportbet.models import Member, Standing
+from sportbet.scoring import remove_snapshot_member
+from sportbet.constants import SPORTBET_NAMESPACE, MEMBER_PROFILE, MASON, MASON_COMPACT
 from sportbet.utils import SportbetBuilder, error_response, validate_api_key,\
-                           debug_print, not_json_request
+                           debug_print, not_json_request, validate_json,\
+                           compact_request, compact_fields, compact_args,\
+                           page_parameters, page_size, page_links, keyset_page
+from sportbet.serializer import item_control, render_item, shared_control,\
+                                sparse_item, stream_response
+from sportbet.urltemplates import href, item_template
+from sportbet.responsecache import cached_response, conditional_response, queue_bump
 
 class MemberCollection(Resource):
     """Resource class handling Member-object lists."""
 
     @validate_api_key
+    @conditional_response
+    @cached_response
     def get(self, event):
         """
         Show list of members in the given event.
-        Members are returned in body["items"] list.
+        Members are returned in body["items"] list, ordered by nickname.
+        Query parameters limit and cursor page the members.
         """
+        try:
+            limit, direction, key = page_parameters((str,))
+        except ValueError as exception:
+            return error_response(400, "Invalid query parameter", str(exception))
+        members, more = keyset_page(Member.query.filter_by(event_id=event.id),
+                                    [Member.nickname], page_size(limit), direction, key)
         body = SportbetBuilder()
         body.add_namespace(SPORTBET_NAMESPACE)
         body.add_control("self",
@@ -29,15 +45,31 @@ class MemberCollection(Resource):
                          title="This resource")
         body.add_control_single_event(event)
         body.add_control_add_member(event)
-        body["items"] = []
-        for member in event.members:
-            item = SportbetBuilder(member.serialize())
-            item.add_control("self",
-                             url_for("api.memberitem", event=event, member=member),
-                             title="Member " + member.nickname)
-            item.add_control("profile", MEMBER_PROFILE, title="Member profile")
-            body["items"].append(item)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        if members:
+            body.add_control_pages("api.membercollection", dict(compact_args(), event=event),
+                                   limit, page_links(direction, key, more),
+                                   [members[0].nickname], [members[-1].nickname])
+        compact = compact_request()
+        if compact:
+            try:
+                fields = compact_fields(["nickname"])
+            except ValueError as exception:
+                return error_response(400, "Invalid query parameter", str(exception))
+            body.add_control("profile", MEMBER_PROFILE, title="Member profile")
+            body.add_control_item_template(item_template("api.memberitem", "member",
+                                                         event=event), "Member")
+        profile = shared_control("profile", MEMBER_PROFILE, "Member profile")
+        def items():
+            for member in members:
+                if compact:
+                    yield render_item(sparse_item(member.serialize(), fields))
+                    continue
+                yield render_item(member.serialize(),
+                                  item_control("self",
+                                               href("api.memberitem", event=event, member=member),
+                                               "Member " + member.nickname),
+                                  profile)
+        return stream_response(body, items(), MASON_COMPACT if compact else MASON)
 
     @validate_api_key
     def post(self, event):
@@ -48,11 +80,14 @@ class MemberCollection(Resource):
         if not_json_request(request):
             return error_response(415, "Unsupported media type", "JSON required")
         try:
-            validate(request.json, Member.json_schema())
+            validate_json(request.json, Member)
             member = Member(event=event)
             member.deserialize(request.json)
+            member.standing = Standing(event_id=event.id, points=0)
             debug_print("Add member " + member.nickname + " to event " + event.name)
             db.session.add(member)
+            ranking.queue_change(event)
+            queue_bump(event)
             db.session.commit()
             return Response(status=201,
                             headers={"Location": url_for("api.memberitem",
@@ -68,6 +103,7 @@ class MemberItem(Resource):
     """Resource class handling single Member-object."""
 
     @validate_api_key
+    @conditional_response
     def get(self, event, member):
         """ Get the given member in the given event. """
         body = SportbetBuilder(member.serialize())
@@ -86,7 +122,11 @@ class MemberItem(Resource):
     def delete(self, event, member):
         """ Delete member in event. Redirect to event member listing. """
         debug_print("Delete member " + member.nickname + " from event " + event.name)
+        stats.queue_invalidation([bet.game_id for bet in member.bets])
+        remove_snapshot_member(event, member)
         db.session.delete(member)
+        ranking.queue_change(event)
+        queue_bump(event)
         db.session.commit()
         return Response(status=204,
                         headers={"Location": url_for("api.membercollection", event=event)})
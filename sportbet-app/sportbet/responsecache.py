@@ -0,0 +1,198 @@
+"""
+Response cache and conditional GET of the read endpoints.
+
+Rendered Mason bodies are cached by event, generation and request path. Each
+event has a generation, which the write handlers bump when their session
+commits, so a cached body of an older generation is never served again.
+The backend is selected with app config RESPONSE_CACHE_TYPE.
+
+The generation is the time of the event's latest change in nanoseconds, it
+gives the ETag and Last-Modified headers of the event's resources. It is
+read once per request, before the URL objects are loaded (see api.py), so
+a response is never older than its generation. Compact
+representations (see utils.compact_request()) are cached and tagged apart.
+"""
+from datetime import datetime, timezone
+from functools import wraps
+import threading
+import time
+
+from flask import Response, current_app, g, request
+from werkzeug.http import http_date
+from sqlalchemy import event as sa_event
+from sqlalchemy.orm import Session
+
+from sportbet import db, response_cache
+from sportbet.constants import MASON, MASON_COMPACT
+from sportbet.models import Event
+from sportbet.utils import compact_request
+
+# shorthand names of the Flask-Caching backends for RESPONSE_CACHE_TYPE
+BACKENDS = {"simple": "SimpleCache", "filesystem": "FileSystemCache", "null": "NullCache"}
+# generation of the event list, not bound to any event
+EVENTS = "events"
+
+_SESSION_KEY = "response_changes"
+# session.info key of the generations bumped by the latest commit,
+# {scope: (previous generation, new generation)} (see ranking.py)
+BUMPS_SESSION_KEY = "generation_bumps"
+_lock = threading.Lock()
+_counters = {"hit": 0, "miss": 0}
+
+def _generation_key(scope):
+    return "generation-" + str(scope)
+
+def generation(scope):
+    """
+    Current generation of the event id (or EVENTS), a new one is started if
+    the cache does not have it.
+    """
+    key = _generation_key(scope)
+    value = response_cache.get(key)
+    if value is None:
+        value = time.time_ns()
+        response_cache.set(key, value, timeout=0)
+    return value
+
+def request_generation(scope):
+    """ Generation of the event id (or EVENTS) for the current request, read once """
+    generations = g.setdefault("generations", {})
+    if scope not in generations:
+        generations[scope] = generation(scope)
+    return generations[scope]
+
+def bump(scope):
+    """
+    Start a new generation, responses cached for the earlier ones are not used.
+        Returns:
+        - (previous generation or None, new generation)
+    """
+    key = _generation_key(scope)
+    previous = response_cache.get(key)
+    # unique value instead of increment, concurrent bumps cannot be lost
+    value = time.time_ns()
+    response_cache.set(key, value, timeout=0)
+    return previous, value
+
+def queue_bump(event):
+    """ Bump the event's generation when the session commits """
+    db.session.info.setdefault(_SESSION_KEY, set()).add(event.id)
+
+def counters():
+    """ Hit and miss counts of this process """
+    with _lock:
+        return dict(_counters)
+
+def _count(name):
+    with _lock:
+        _counters[name] += 1
+
+def _scope(kwargs):
+    """ Generation scope of the request: event id, or EVENTS without an event """
+    event = kwargs.get("event")
+    return event.id if event is not None else EVENTS
+
+def conditional_response(func):
+    """
+    Conditional GET wrapper of a resource GET method, use inside
+    validate_api_key. Responses get ETag and Last-Modified headers from the
+    event's generation, and 304 Not Modified is returned without calling
+    the method when the request's If-None-Match (or If-Modified-Since)
+    matches. Last-Modified has whole seconds, so it is given and
+    If-Modified-Since is used only when the generation is at least a second
+    old: a later write cannot fall into the same second then.
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        scope = _scope(kwargs)
+        version = request_generation(scope)
+        etag = str(scope) + "-" + format(version, "x")
+        if compact_request():
+            etag += "-compact"
+        modified = datetime.fromtimestamp(version // 1000000000, timezone.utc)
+        headers = {"ETag": '"' + etag + '"', "Vary": "Accept"}
+        settled = time.time_ns() - version >= 1000000000
+        if settled:
+            headers["Last-Modified"] = http_date(modified)
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            not_modified = settled and request.if_modified_since is not None and\
+                           modified <= request.if_modified_since
+        if not_modified:
+            return Response(status=304, headers=headers)
+        resp = func(self, *args, **kwargs)
+        if resp.status_code == 200:
+            resp.headers.update(headers)
+        return resp
+    return wrapper
+
+def cached_response(func):
+    """
+    Response cache wrapper of a resource GET method, use inside
+    validate_api_key. Only 200 responses are cached, streamed ones when they
+    are not larger than RESPONSE_CACHE_MAX_SIZE. X-Cache response header
+    tells whether the body came from the cache.
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        scope = _scope(kwargs)
+        compact = compact_request()
+        key = "response-" + str(scope) + "-" + str(request_generation(scope)) + "-" +\
+              request.full_path + ("-compact" if compact else "")
+        body = response_cache.get(key)
+        if body is not None:
+            _count("hit")
+            return Response(body, 200, content_type=MASON_COMPACT if compact else MASON,
+                            headers={"X-Cache": "HIT"})
+        _count("miss")
+        resp = func(self, *args, **kwargs)
+        if resp.status_code == 200 and resp.is_streamed:
+            limit = current_app.config["RESPONSE_CACHE_MAX_SIZE"]
+            resp.response = _cache_streamed(resp.response, key, limit, response_cache.cache)
+        elif resp.status_code == 200:
+            response_cache.set(key, resp.get_data())
+        resp.headers["X-Cache"] = "MISS"
+        return resp
+    return wrapper
+
+def _cache_streamed(chunks, key, limit, backend):
+    """
+    Pass the chunks through, the body is cached once complete if it fits the
+    limit. The backend is given as the request context may be gone by then.
+    """
+    parts = []
+    size = 0
+    for chunk in chunks:
+        if parts is not None:
+            size += len(chunk)
+            if size <= limit:
+                parts.append(chunk)
+            else:
+                parts = None
+        yield chunk
+    if parts is not None:
+        backend.set(key, "".join(parts))
+
+@sa_event.listens_for(Session, "after_flush")
+def _track_events(session, flush_context):
+    # added, changed and removed events change the event list too
+    changed = [obj for obj in list(session.new) + list(session.deleted)
+               if isinstance(obj, Event)]
+    changed += [obj for obj in session.dirty
+                if isinstance(obj, Event) and session.is_modified(obj, include_collections=False)]
+    if changed:
+        scopes = session.info.setdefault(_SESSION_KEY, set())
+        scopes.add(EVENTS)
+        scopes.update(obj.id for obj in changed)
+
+@sa_event.listens_for(Session, "after_commit")
+def _apply_changes(session):
+    bumps = {scope: bump(scope) for scope in session.info.pop(_SESSION_KEY, ())}
+    if bumps:
+        session.info[BUMPS_SESSION_KEY] = bumps
+
+@sa_event.listens_for(Session, "after_soft_rollback")
+def _discard_changes(session, previous_transaction):
+    session.info.pop(_SESSION_KEY, None)
+    session.info.pop(BUMPS_SESSION_KEY, None)
@@ -0,0 +1,551 @@
+"""
+Bet scoring engine: point rules for a single bet, aggregate SQL queries
+computing the betting status (member points) of an event, and maintenance
+of the materialized betting status (Standing and StandingSnapshot tables).
+"""
+from array import array
+import click
+from flask.cli import with_appcontext
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from sqlalchemy import and_, case, func, literal, or_, select, update
+
+from sportbet import db, ranking, responsecache
+from sportbet.models import Event, Member, Game, Bet, Standing, StandingSnapshot
+
+# Lookup table dimensions: exact result (2) x goal difference equal (2) x
+# bet winner (3: guest, draw, home) x result winner (4: guest, draw, home, not played)
+_BET_CLASSES = 3
+_RESULT_CLASSES = 4
+_NOT_PLAYED = 3
+
+class ScoringRules:
+    """
+    Point rules of an event. The rules are compiled into a lookup table when
+    the object is created, so scoring a bet only calculates the table index
+    from the goals and no rule branches are evaluated per bet.
+    """
+    def __init__(self, name, exact=3, goal_difference=2, winner=1):
+        self.name = name
+        self.exact = exact
+        self.goal_difference = goal_difference
+        self.winner = winner
+        self.table = tuple(self._rule_points(idx) for idx in range(self.table_size()))
+
+    @staticmethod
+    def table_size():
+        """ Number of lookup table entries """
+        return 2 * 2 * _BET_CLASSES * _RESULT_CLASSES
+
+    def _rule_points(self, idx):
+        """ Evaluate the point rules for the given table index (compile time only) """
+        result_class = idx % _RESULT_CLASSES
+        bet_class = idx // _RESULT_CLASSES % _BET_CLASSES
+        same_difference = idx // (_RESULT_CLASSES * _BET_CLASSES) % 2
+        exact = idx // (_RESULT_CLASSES * _BET_CLASSES * 2)
+        # Game not played yet
+        if result_class == _NOT_PLAYED:
+            return 0
+        # Exactly correct result
+        if exact:
+            return self.exact
+        # Goal difference correct (also event result)
+        if same_difference:
+            return self.goal_difference
+        # Winner correct
+        if bet_class == result_class and bet_class != 1:
+            return self.winner
+        return 0
+
+    @staticmethod
+    def index(bet_home, bet_guest, game_home, game_guest):
+        """ Lookup table index of a bet, negative game_home means not played yet """
+        played = game_home >= 0
+        result_class = played * ((game_home > game_guest) - (game_home < game_guest) + 1) +\
+                       (not played) * _NOT_PLAYED
+        bet_class = (bet_home > bet_guest) - (bet_home < bet_guest) + 1
+        same_difference = (bet_home - bet_guest) == (game_home - game_guest)
+        exact = (bet_home == game_home) & (bet_guest == game_guest)
+        return ((exact * 2 + same_difference) * _BET_CLASSES + bet_class) *\
+               _RESULT_CLASSES + result_class
+
+    def points(self, bet_home, bet_guest, game_home, game_guest):
+        """ Points for a single bet """
+        return self.table[self.index(bet_home, bet_guest, game_home, game_guest)]
+
+    def serialize(self):
+        """ From Python object to JSON """
+        return {
+            "name": self.name,
+            "exact": self.exact,
+            "goal_difference": self.goal_difference,
+            "winner": self.winner
+        }
+
+# Rule sets selectable by Event.scoring, more can be given in app config
+# SCORING_RULES as {name: {"exact": 3, "goal_difference": 2, "winner": 1}}
+DEFAULT_RULES = "standard"
+RULE_SETS = {
+    DEFAULT_RULES: ScoringRules(DEFAULT_RULES, exact=3, goal_difference=2, winner=1)
+}
+
+def register_rules(name, **points):
+    """ Compile and register a named rule set """
+    RULE_SETS[name] = ScoringRules(name, **points)
+
+def rules_for(event):
+    """
+    Scoring rules of the given event.
+        Parameters:
+        - event: Event object
+        Returns:
+        - ScoringRules object, KeyError if the event's rule set is not registered
+    """
+    return RULE_SETS[event.scoring or DEFAULT_RULES]
+
+def bet_points(bet_home, bet_guest, game_home, game_guest, rules=None):
+    """
+    Calculate points for a single bet.
+        Parameters:
+        - bet_home, bet_guest: goals given in the bet
+        - game_home, game_guest: game result goals (negative if not played yet)
+        - rules: ScoringRules object, default rules if not given
+        Returns:
+        - points for exactly correct result, correct goal difference,
+          or correct winner (standard rules 3/2/1), otherwise 0
+    """
+    if rules is None:
+        rules = RULE_SETS[DEFAULT_RULES]
+    return rules.points(bet_home, bet_guest, game_home, game_guest)
+
+def score_batch(bet_home, bet_guest, game_home, game_guest, rules=None):
+    """
+    Calculate points for many bets at once with table lookups.
+    Uses vectorized NumPy operations when NumPy is installed, otherwise
+    falls back to calling bet_points() for each bet.
+        Parameters:
+        - bet_home, bet_guest: sequences of goals given in the bets
+        - game_home, game_guest: sequences of result goals for the bets
+        - rules: ScoringRules object, default rules if not given
+        Returns:
+        - points as NumPy integer array (list without NumPy)
+    """
+    if rules is None:
+        rules = RULE_SETS[DEFAULT_RULES]
+    if np is None:
+        return [rules.points(*goals) for goals in zip(bet_home, bet_guest, game_home, game_guest)]
+    bet_home = np.asarray(bet_home)
+    bet_guest = np.asarray(bet_guest)
+    game_home = np.asarray(game_home)
+    game_guest = np.asarray(game_guest)
+    result_class = np.where(game_home < 0, _NOT_PLAYED, np.sign(game_home - game_guest) + 1)
+    bet_class = np.sign(bet_home - bet_guest) + 1
+    same_difference = (bet_home - bet_guest) == (game_home - game_guest)
+    exact = (bet_home == game_home) & (bet_guest == game_guest)
+    index = ((exact * 2 + same_difference) * _BET_CLASSES + bet_class) *\
+            _RESULT_CLASSES + result_class
+    return np.asarray(rules.table)[index]
+
+def _sign_class(larger, smaller, equal_class=1):
+    """ SQL expression: 2 when larger > smaller, 0 when smaller, else equal_class """
+    return case((larger > smaller, 2), (larger < smaller, 0), else_=equal_class)
+
+def _points_expression(rules):
+    """ SQL expression of the rule table lookup for a row joining Bet and Game """
+    exact = case((and_(Bet.home_goals == Game.home_goals,
+                       Bet.guest_goals == Game.guest_goals), 1), else_=0)
+    same_difference = case(((Bet.home_goals - Bet.guest_goals) ==
+                            (Game.home_goals - Game.guest_goals), 1), else_=0)
+    bet_class = _sign_class(Bet.home_goals, Bet.guest_goals)
+    result_class = case((Game.home_goals < 0, _NOT_PLAYED),
+                        else_=_sign_class(Game.home_goals, Game.guest_goals))
+    index = ((exact * 2 + same_difference) * _BET_CLASSES + bet_class) *\
+            _RESULT_CLASSES + result_class
+    lookup = {idx: pts for idx, pts in enumerate(rules.table) if pts != 0}
+    if not lookup:
+        return literal(0)
+    return case(lookup, value=index, else_=0)
+
+def _totals_statement(event):
+    """ Aggregate query for the total points of event members """
+    total = func.coalesce(func.sum(_points_expression(rules_for(event))), 0).label("points")
+    return select(Member, total)\
+        .outerjoin(Bet, Bet.member_id == Member.id)\
+        .outerjoin(Game, Game.id == Bet.game_id)\
+        .where(Member.event_id == event.id)\
+        .group_by(Member.id)\
+        .order_by(total.desc(), Member.id)
+
+def event_points(event):
+    """
+    Total points of all event members, calculated with one aggregate query.
+        Parameters:
+        - event: Event object
+        Returns:
+        - list of (Member, points) tuples, highest points first
+    """
+    return db.session.execute(_totals_statement(event)).all()
+
+def member_points(event, member):
+    """
+    Points for each bet of the given member, calculated with one query.
+        Parameters:
+        - event: Event object
+        - member: Member object
+        Returns:
+        - list of rows (game_nbr, points, game_home, game_guest, bet_home,
+          bet_guest) ordered by game number
+    """
+    stmt = select(Game.game_nbr,
+                  _points_expression(rules_for(event)).label("points"),
+                  Game.home_goals.label("game_home"),
+                  Game.guest_goals.label("game_guest"),
+                  Bet.home_goals.label("bet_home"),
+                  Bet.guest_goals.label("bet_guest"))\
+        .join(Bet.game)\
+        .where(Bet.member_id == member.id, Game.event_id == event.id)\
+        .order_by(Game.game_nbr, Bet.id)
+    return db.session.execute(stmt).all()
+
+# ----------------- MATERIALIZED BETTING STATUS ----------------
+# Standing rows are updated in the same transaction as the bet or
+# game result changes, the caller commits the session.
+# --------------------------------------------------------------
+
+def standings(event):
+    """
+    Read the materialized total points of all event members.
+        Parameters:
+        - event: Event object
+        Returns:
+        - list of (Member, points) tuples, highest points first, then by nickname
+    """
+    return standings_page(event)[0]
+
+def standings_page(event, limit=None, direction="next", key=None):
+    """
+    Read a page of the materialized betting status with keyset pagination,
+    ordered by points (highest first) and nickname. Uses the Standing
+    (event_id, points) index, so only the page rows are read.
+        Parameters:
+        - event: Event object
+        - limit: page size, None for all rows
+        - direction: "next" for rows after key, "prev" for rows before key
+        - key: [points, nickname] of the page boundary row, None for first page
+        Returns:
+        - (list of (Member, points) tuples, True if more rows in page direction)
+    """
+    stmt = select(Member, Standing.points)\
+        .join(Standing, Standing.member_id == Member.id)\
+        .where(Standing.event_id == event.id)
+    if direction == "next":
+        if key is not None:
+            stmt = stmt.where(or_(Standing.points < key[0],
+                                  and_(Standing.points == key[0], Member.nickname > key[1])))
+        stmt = stmt.order_by(Standing.points.desc(), Member.nickname)
+    else:
+        if key is not None:
+            stmt = stmt.where(or_(Standing.points > key[0],
+                                  and_(Standing.points == key[0], Member.nickname < key[1])))
+        stmt = stmt.order_by(Standing.points, Member.nickname.desc())
+    if limit is not None:
+        stmt = stmt.limit(limit + 1)
+    rows = db.session.execute(stmt).all()
+    more = limit is not None and len(rows) > limit
+    rows = rows[:limit]
+    if direction == "prev":
+        rows.reverse()
+    return rows, more
+
+def apply_bet_change(event, member, game, old_bet, new_bet):
+    """
+    Add the point change of a new or updated bet to the member's total.
+        Parameters:
+        - event, member, game: objects the bet belongs to
+        - old_bet: (home_goals, guest_goals) before the change, None for a new bet
+        - new_bet: (home_goals, guest_goals) after the change
+    """
+    rules = rules_for(event)
+    delta = rules.points(*new_bet, game.home_goals, game.guest_goals)
+    if old_bet is not None:
+        delta -= rules.points(*old_bet, game.home_goals, game.guest_goals)
+    if delta != 0:
+        _add_points(event, {member.id: delta})
+        snapshot = StandingSnapshot.query.filter_by(game_id=game.id).first()
+        _shift_snapshots(event, snapshot, {member.id: delta})
+
+def apply_bet_changes(event, member, changes):
+    """
+    Add the point changes of many new or updated bets of a member to the
+    member's total, the standing and the snapshots are updated once.
+        Parameters:
+        - event, member: objects the bets belong to
+        - changes: list of (game, old_bet or None, new_bet), see apply_bet_change()
+    """
+    rules = rules_for(event)
+    deltas = {}
+    for game, old_bet, new_bet in changes:
+        delta = rules.points(*new_bet, game.home_goals, game.guest_goals)
+        if old_bet is not None:
+            delta -= rules.points(*old_bet, game.home_goals, game.guest_goals)
+        if delta != 0:
+            deltas[game.id] = delta
+    if not deltas:
+        return
+    total = sum(deltas.values())
+    if total != 0:
+        _add_points(event, {member.id: total})
+    # a snapshot gets the deltas of its own game and of the games before it
+    shift = 0
+    snapshots = StandingSnapshot.query.filter_by(event_id=event.id)\
+                                      .order_by(StandingSnapshot.seq)
+    for snap in snapshots:
+        shift += deltas.get(snap.game_id, 0)
+        if shift != 0:
+            snap_points = dict(unpack_ranking(snap.ranking))
+            snap_points[member.id] = snap_points.get(member.id, 0) + shift
+            snap.ranking = pack_ranking(sorted(snap_points.items(),
+                                               key=lambda row: (-row[1], row[0])))
+
+def apply_result_change(event, game, old_result, new_result):
+    """
+    Add the point changes of a game result update to the member totals.
+    Only the bets of the given game are read, so the cost is independent
+    of the number of games in the event.
+        Parameters:
+        - event: Event object
+        - game: Game object
+        - old_result: (home_goals, guest_goals) before the change
+        - new_result: (home_goals, guest_goals) after the change, (-1, -1)
+          when the result is reset or the game is deleted
+    """
+    stmt = select(Bet.member_id, Bet.home_goals, Bet.guest_goals).where(Bet.game_id == game.id)
+    rows = db.session.execute(stmt).all() if old_result != new_result else []
+    deltas = _result_deltas(rows, old_result, new_result, rules_for(event))
+    _add_points(event, deltas)
+    _update_snapshots(event, game, new_result, deltas)
+
+def apply_result_changes(event, changes):
+    """
+    Add the point changes of many game result updates to the member totals,
+    same as apply_result_change() for each change in the given order. The
+    bets of all the games are read with one query, and the standings and
+    the snapshots are updated once.
+        Parameters:
+        - event: Event object
+        - changes: list of (game, old_result, new_result)
+    """
+    changes = [change for change in changes if change[1] != change[2]]
+    if not changes:
+        return
+    rules = rules_for(event)
+    bets = {}
+    stmt = select(Bet.game_id, Bet.member_id, Bet.home_goals, Bet.guest_goals)\
+        .where(Bet.game_id.in_([game.id for game, old_result, new_result in changes]))
+    for row in db.session.execute(stmt):
+        bets.setdefault(row.game_id, []).append(row[1:])
+    # running betting status and snapshot rankings, written once at the end
+    current = dict(unpack_ranking(_current_ranking(event)))
+    snapshots = StandingSnapshot.query.filter_by(event_id=event.id)\
+                                      .order_by(StandingSnapshot.seq).all()
+    rankings = {snap.game_id: dict(unpack_ranking(snap.ranking)) for snap in snapshots}
+    total = {}
+    for game, old_result, new_result in changes:
+        deltas = _result_deltas(bets.get(game.id, []), old_result, new_result, rules)
+        for member_id, delta in deltas.items():
+            total[member_id] = total.get(member_id, 0) + delta
+            current[member_id] = current.get(member_id, 0) + delta
+        games = [snap.game_id for snap in snapshots]
+        if game.id in games:
+            position = games.index(game.id)
+            # a reset result removes the game's snapshot, later ones are shifted
+            shifted = snapshots[position + 1:] if new_result[0] < 0 else snapshots[position:]
+            for snap in shifted:
+                for member_id, delta in deltas.items():
+                    snap_points = rankings[snap.game_id]
+                    snap_points[member_id] = snap_points.get(member_id, 0) + delta
+            if new_result[0] < 0:
+                db.session.delete(snapshots.pop(position))
+        elif new_result[0] >= 0:
+            snapshot = StandingSnapshot(event_id=event.id, game_id=game.id,
+                                        seq=(snapshots[-1].seq if snapshots else 0) + 1)
+            db.session.add(snapshot)
+            snapshots.append(snapshot)
+            rankings[game.id] = dict(current)
+    for snap in snapshots:
+        snap.ranking = pack_ranking(sorted(rankings[snap.game_id].items(),
+                                           key=lambda row: (-row[1], row[0])))
+    _add_points(event, {member_id: delta for member_id, delta in total.items() if delta != 0})
+
+def _result_deltas(rows, old_result, new_result, rules):
+    """ Point deltas {member_id: delta} of a game's bets (member_id, home, guest) """
+    deltas = {}
+    if rows:
+        member_ids, bet_home, bet_guest = zip(*rows)
+        count = len(rows)
+        new_points = score_batch(bet_home, bet_guest, [new_result[0]] * count,
+                                 [new_result[1]] * count, rules)
+        old_points = score_batch(bet_home, bet_guest, [old_result[0]] * count,
+                                 [old_result[1]] * count, rules)
+        for member_id, new_pts, old_pts in zip(member_ids, new_points, old_points):
+            if new_pts != old_pts:
+                deltas[member_id] = deltas.get(member_id, 0) + int(new_pts - old_pts)
+    return deltas
+
+def _add_points(event, deltas):
+    """ Add point deltas {member_id: delta} to Standing rows with SQL updates """
+    if not deltas:
+        return
+    ranking.queue_change(event, deltas)
+    existing = set(db.session.scalars(
+        select(Standing.member_id).where(Standing.member_id.in_(deltas.keys()))))
+    # one UPDATE per distinct delta value keeps the increments atomic
+    by_delta = {}
+    for member_id, delta in deltas.items():
+        if member_id in existing:
+            by_delta.setdefault(delta, []).append(member_id)
+        else:
+            db.session.add(Standing(member_id=member_id, event_id=event.id, points=delta))
+    for delta, member_ids in by_delta.items():
+        db.session.execute(update(Standing)
+                           .where(Standing.member_id.in_(member_ids))
+                           .values(points=Standing.points + delta))
+
+# ----------------- BETTING STATUS SNAPSHOTS ----------------
+# A snapshot is taken when a game result is set. Point changes of that
+# game (result corrections, bet updates) are added to the game's snapshot
+# and to all snapshots taken after it, and resetting the result removes
+# the game's snapshot.
+# ------------------------------------------------------------
+
+def pack_ranking(rows):
+    """ Pack (member id, points) pairs into snapshot bytes """
+    data = array("i")
+    for member_id, points in rows:
+        data.append(member_id)
+        data.append(points)
+    return data.tobytes()
+
+def unpack_ranking(packed):
+    """ Unpack snapshot bytes into a list of (member id, points) pairs """
+    data = array("i")
+    data.frombytes(packed)
+    return list(zip(data[0::2], data[1::2]))
+
+def _current_ranking(event):
+    """ Packed current betting status of the event """
+    points = func.coalesce(Standing.points, 0).label("points")
+    stmt = select(Member.id, points)\
+        .outerjoin(Standing, Standing.member_id == Member.id)\
+        .where(Member.event_id == event.id)\
+        .order_by(points.desc(), Member.id)
+    return pack_ranking(db.session.execute(stmt).all())
+
+def _shift_snapshots(event, snapshot, deltas, include_snapshot=True):
+    """ Add point deltas to the given snapshot and all snapshots after it """
+    if snapshot is None or not deltas:
+        return
+    first_seq = snapshot.seq if include_snapshot else snapshot.seq + 1
+    later = StandingSnapshot.query.filter(StandingSnapshot.event_id == event.id,
+                                          StandingSnapshot.seq >= first_seq)
+    for snap in later:
+        snap_points = dict(unpack_ranking(snap.ranking))
+        for member_id, delta in deltas.items():
+            snap_points[member_id] = snap_points.get(member_id, 0) + delta
+        snap.ranking = pack_ranking(sorted(snap_points.items(),
+                                           key=lambda row: (-row[1], row[0])))
+
+def _update_snapshots(event, game, new_result, deltas):
+    """ Take, correct or remove the snapshot of a game after a result change """
+    snapshot = StandingSnapshot.query.filter_by(game_id=game.id).first()
+    if new_result[0] < 0:
+        if snapshot is not None:
+            _shift_snapshots(event, snapshot, deltas, include_snapshot=False)
+            db.session.delete(snapshot)
+    elif snapshot is None:
+        last_seq = db.session.scalar(select(func.max(StandingSnapshot.seq))
+                                     .where(StandingSnapshot.event_id == event.id))
+        db.session.add(StandingSnapshot(event_id=event.id,
+                                        game_id=game.id,
+                                        seq=(last_seq or 0) + 1,
+                                        ranking=_current_ranking(event)))
+    else:
+        _shift_snapshots(event, snapshot, deltas)
+
+def remove_snapshot_member(event, member):
+    """
+    Remove a deleted member from all snapshots of the event, so that a
+    member added later with the same (reused) id does not get the points.
+        Parameters:
+        - event: Event object
+        - member: Member object being deleted
+    """
+    for snap in StandingSnapshot.query.filter_by(event_id=event.id):
+        rows = unpack_ranking(snap.ranking)
+        if any(member_id == member.id for member_id, _ in rows):
+            snap.ranking = pack_ranking([row for row in rows if row[0] != member.id])
+
+def snapshot_standings(event, game_nbr):
+    """
+    Betting status of the event after the given game's result was set.
+        Parameters:
+        - event: Event object
+        - game_nbr: game number
+        Returns:
+        - list of (Member, points) tuples, highest points first, then by
+          nickname, or None if the game has no result
+    """
+    stmt = select(StandingSnapshot.ranking)\
+        .join(StandingSnapshot.game)\
+        .where(Game.event_id == event.id, Game.game_nbr == game_nbr)
+    packed = db.session.scalar(stmt)
+    if packed is None:
+        return None
+    members = {member.id: member for member in Member.query.filter_by(event_id=event.id)}
+    rows = [(members[member_id], points) for member_id, points in unpack_ranking(packed)
+            if member_id in members]
+    return sorted(rows, key=lambda row: (-row[1], row[0].nickname))
+
+def rebuild_standings(event):
+    """ Rebuild the materialized betting status of the event from scratch. """
+    Standing.query.filter_by(event_id=event.id).delete()
+    ranking.queue_change(event)
+    for member, points in event_points(event):
+        db.session.add(Standing(member_id=member.id, event_id=event.id, points=points))
+
+def check_standings(event):
+    """
+    Compare the materialized betting status against calculated points.
+        Parameters:
+        - event: Event object
+        Returns:
+        - list of (nickname, stored points, calculated points) for drifted
+          members, stored points are None if the member's row is missing
+    """
+    stored = {member.id: points for member, points in standings(event)}
+    drift = []
+    for member, points in event_points(event):
+        if stored.get(member.id) != points:
+            drift.append((member.nickname, stored.get(member.id), points))
+    return drift
+
+@click.command("standings-rebuild")
+@click.option("--check", is_flag=True, help="Only report drift, do not rebuild.")
+@with_appcontext
+def standings_rebuild(check):
+    """ Rebuild materialized betting status and report drift """
+    # create Standing table if database was created with an older version
+    db.create_all()
+    for event in Event.query.all():
+        drift = check_standings(event)
+        for nickname, stored, points in drift:
+            click.echo(event.name + "/" + nickname + ": stored " + str(stored) +\
+                       ", calculated " + str(points))
+        if not check:
+            rebuild_standings(event)
+            responsecache.queue_bump(event)
+        click.echo(event.name + ": " + str(len(drift)) + " members drifted" +\
+                   ("" if check else ", rebuilt"))
+    db.session.commit()
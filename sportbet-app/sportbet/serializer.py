@@ -0,0 +1,102 @@
+"""
+Fast Mason serialization of collection responses.
+
+The collection body without its items is rendered once, controls shared by
+all items (e.g. profile) are pre-rendered once per process, and per-item
+hrefs are filled into URL templates (see urltemplates.py). The output is
+byte-identical to json.dumps() of the same body built with SportbetBuilder.
+
+Collection pages are streamed: the items are rendered while the response
+is sent.
+"""
+from functools import lru_cache
+import json
+
+from flask import Response, stream_with_context
+
+from sportbet.constants import MASON
+
+# approximate size of the streamed chunks (characters)
+CHUNK_SIZE = 16384
+
+@lru_cache(maxsize=None)
+def shared_control(name, href, title):
+    """ Pre-rendered '"name": {...}' control shared by items, as add_control() builds it """
+    return item_control(name, href, title)
+
+def item_control(name, href, title):
+    """ Rendered '"name": {...}' control of one item """
+    return json.dumps(name) + ": " + json.dumps({"title": title, "href": href})
+
+def sparse_item(fields, names):
+    """ Sparse fieldset of an item: only the given fields, in the given order """
+    return {name: fields[name] for name in names}
+
+def _open(rendered):
+    """ Rendered JSON object without the closing brace, ready for more members """
+    return rendered[:-1] + ", " if len(rendered) > 2 else "{"
+
+def render_item(fields, *controls):
+    """
+    Rendered item.
+        Parameters:
+        - fields: item's serialized fields (dictionary)
+        - controls: rendered controls, see shared_control() and item_control(),
+          items of compact collections have none
+        Returns:
+        - item as JSON string
+    """
+    if not controls:
+        return json.dumps(fields)
+    return _open(json.dumps(fields)) + '"@controls": {' + ", ".join(controls) + "}}"
+
+class CollectionSerializer:
+    """
+    Mason collection body: the given builder has everything else than
+    "items", items are added already rendered.
+    """
+    def __init__(self, body):
+        self.head = _open(json.dumps(body))
+        self.items = []
+
+    def add_item(self, fields, *controls):
+        """ Add an item, see render_item() """
+        self.items.append(render_item(fields, *controls))
+
+    def render(self):
+        """ Body as JSON string """
+        return self.head + '"items": [' + ", ".join(self.items) + "]}"
+
+    def stream(self, items):
+        """
+        Body as JSON string chunks, same as render() gives joined.
+            Parameters:
+            - items: iterable of rendered items, consumed while streaming
+        """
+        chunk = [self.head + '"items": [']
+        size = 0
+        separator = ""
+        for item in items:
+            chunk.append(separator + item)
+            separator = ", "
+            size += len(item)
+            if size >= CHUNK_SIZE:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+        chunk.append("]}")
+        yield "".join(chunk)
+
+def stream_response(body, items, content_type=MASON):
+    """
+    Streamed 200 response of a collection, memory use does not grow with
+    the number of items.
+        Parameters:
+        - body: collection body without "items" (SportbetBuilder)
+        - items: generator of rendered items, see render_item()
+        - content_type: response Content-Type
+        Returns:
+        - Response
+    """
+    chunks = CollectionSerializer(body).stream(items)
+    return Response(stream_with_context(chunks), 200, content_type=content_type)
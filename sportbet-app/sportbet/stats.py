@@ -0,0 +1,74 @@
+"""
+Bet distribution statistics of games.
+
+Statistics are aggregated in the database and cached per game. Bet changes
+queue the affected games in the database session and the cached statistics
+are dropped only when the session commits.
+"""
+from flask import current_app
+from sqlalchemy import event as sa_event, case, func, select
+from sqlalchemy.orm import Session
+
+from sportbet import db, cache
+from sportbet.models import Bet
+
+_SESSION_KEY = "stats_changes"
+
+def _cache_key(game_id):
+    return "game-stats-" + str(game_id)
+
+def game_stats(game):
+    """
+    Bet distribution of the game, cached until a bet on the game changes.
+        Parameters:
+        - game: Game object
+        Returns:
+        - dictionary with "bets", "home_win", "draw", "away_win",
+          "average_home_goals", "average_guest_goals" (None if no bets) and
+          "top_scores" list of {"score", "bets"} (most common first)
+    """
+    key = _cache_key(game.id)
+    stats = cache.get(key)
+    if stats is None:
+        stats = _aggregate(game.id)
+        cache.set(key, stats, timeout=current_app.config["STATS_CACHE_TIMEOUT"])
+    return stats
+
+def _aggregate(game_id):
+    """ Calculate game statistics with GROUP BY aggregates over Bet """
+    stmt = select(func.count(),
+                  func.sum(case((Bet.home_goals > Bet.guest_goals, 1), else_=0)),
+                  func.sum(case((Bet.home_goals == Bet.guest_goals, 1), else_=0)),
+                  func.sum(case((Bet.home_goals < Bet.guest_goals, 1), else_=0)),
+                  func.avg(Bet.home_goals),
+                  func.avg(Bet.guest_goals))\
+        .where(Bet.game_id == game_id)
+    count, home_win, draw, away_win, home_avg, guest_avg = db.session.execute(stmt).one()
+    stmt = select(Bet.home_goals, Bet.guest_goals, func.count().label("bets"))\
+        .where(Bet.game_id == game_id)\
+        .group_by(Bet.home_goals, Bet.guest_goals)\
+        .order_by(func.count().desc(), Bet.home_goals, Bet.guest_goals)\
+        .limit(current_app.config["STATS_TOP_SCORES"])
+    top_scores = [{"score": str(home) + "-" + str(guest), "bets": bets}
+                  for home, guest, bets in db.session.execute(stmt)]
+    return {"bets": count,
+            "home_win": home_win or 0,
+            "draw": draw or 0,
+            "away_win": away_win or 0,
+            "average_home_goals": round(home_avg, 2) if home_avg is not None else None,
+            "average_guest_goals": round(guest_avg, 2) if guest_avg is not None else None,
+            "top_scores": top_scores}
+
+def queue_invalidation(game_ids):
+    """ Drop the cached statistics of the given games when the session commits """
+    db.session.info.setdefault(_SESSION_KEY, set()).update(game_ids)
+
+@sa_event.listens_for(Session, "after_commit")
+def _invalidate(session):
+    game_ids = session.info.pop(_SESSION_KEY, None)
+    if game_ids:
+        cache.delete_many(*[_cache_key(game_id) for game_id in game_ids])
+
+@sa_event.listens_for(Session, "after_soft_rollback")
+def _discard_changes(session, previous_transaction):
+    session.info.pop(_SESSION_KEY, None)
@@ -0,0 +1,83 @@
+"""
+URL templates of the API resources for building hypermedia control hrefs.
+
+A template is built with url_for() once per app for each endpoint and set of
+object arguments (event, member, game), after that an href is plain string
+formatting of the quoted object identifiers. Endpoints the templates do not
+cover, e.g. query string arguments, fall back to url_for().
+"""
+import threading
+from urllib.parse import quote
+
+from flask import current_app, request, url_for
+
+# object URL arguments and their identifier attribute
+OBJECT_ARGS = {"event": "name", "member": "nickname", "game": "game_nbr"}
+
+# characters of an URL path segment which are not quoted
+_SAFE = "!$&'()*+,:;=@"
+_lock = threading.Lock()
+
+def quote_segment(value):
+    """ Identifier quoted for an URL path segment, as the converters quote it """
+    return quote(str(value), safe=_SAFE)
+
+class _Placeholder:
+    """ Stands for any Event, Member or Game in url_for() """
+    def __init__(self, arg):
+        self.name = self.nickname = self.game_nbr = "__" + arg + "__"
+
+def _build(endpoint, args):
+    """ Template of the endpoint for str.format(), None if it cannot be built """
+    url = url_for(endpoint, **{arg: _Placeholder(arg) for arg in args})
+    template = url.replace("{", "{{").replace("}", "}}")
+    for arg in args:
+        if template.count("__" + arg + "__") != 1:
+            return None
+        template = template.replace("__" + arg + "__", "{" + arg + "}")
+    return template
+
+def _template(endpoint, args):
+    """ Cached template of the endpoint and sorted object arguments, "" if not available """
+    templates = current_app.extensions.setdefault("url_templates", {})
+    key = (request.script_root, endpoint, args)
+    template = templates.get(key)
+    if template is None:
+        template = _build(endpoint, args)
+        with _lock:
+            templates[key] = template or ""
+    return template or ""
+
+def href(endpoint, **values):
+    """
+    Href of the resource, same as url_for() gives.
+        Parameters:
+        - endpoint: endpoint of the resource
+        - values: URL arguments, Event, Member and Game objects (None ignored)
+        Returns:
+        - href string
+    """
+    args = tuple(sorted(arg for arg, value in values.items() if value is not None))
+    if not OBJECT_ARGS.keys() >= set(args):
+        return url_for(endpoint, **values)
+    template = _template(endpoint, args)
+    if not template:
+        return url_for(endpoint, **values)
+    return template.format(**{arg: quote_segment(getattr(values[arg], OBJECT_ARGS[arg]))
+                              for arg in args})
+
+def item_template(endpoint, item_arg, **values):
+    """
+    Mason href template of a collection's items, e.g. /api/<event>/games/{game_nbr}/
+        Parameters:
+        - endpoint: endpoint of the item resource
+        - item_arg: URL argument which changes from item to item
+        - values: other URL arguments (Event, Member and Game objects)
+        Returns:
+        - href template, the item's identifier field in braces
+    """
+    template = _template(endpoint, tuple(sorted(list(values) + [item_arg])))
+    fields = {arg: quote_segment(getattr(value, OBJECT_ARGS[arg]))
+              for arg, value in values.items()}
+    fields[item_arg] = "{" + OBJECT_ARGS[item_arg] + "}"
+    return template.format(**fields)
@@ -1,13 +1,20 @@
 """
 Utility functions to be used by multiple other files.
 """
+import base64
 import json
-import secrets
-from flask import Response, request, url_for
-from werkzeug.exceptions import Forbidden, NotFound
+from flask import Response, current_app, g, request, url_for
+from jsonschema import validators
+from jsonschema.exceptions import best_match
+from werkzeug.exceptions import Forbidden
+from werkzeug.http import parse_options_header
 from werkzeug.routing import BaseConverter
+from sqlalchemy import and_, or_
 
-from sportbet.constants import SPORTBET_NAMESPACE, SPORTBET_API_KEY_NAME, JSON, MASON, ERROR_PROFILE
+from sportbet.constants import SPORTBET_NAMESPACE, SPORTBET_API_KEY_NAME, JSON, MASON,\
+                               ERROR_PROFILE, COMPACT
+from sportbet import identity, keycache, ratelimit, urltemplates
+from sportbet.urltemplates import quote_segment
 from sportbet.models import Event, Member, Game, Bet, ApiKey
 
 def not_json_request(req):
@@ -16,6 +23,47 @@ def not_json_request(req):
         return True
     return False
 
+# Request body schemas (model, json_schema() arguments) compiled at app start
+REQUEST_SCHEMAS = [
+    (Member, {}),
+    (Game, {"only_goals": False}),
+    (Game, {"only_goals": True}),
+    (Bet, {"full_format": False}),
+]
+_validators = {}
+
+def schema_validator(model, **variant):
+    """
+    Compiled validator of the model's JSON schema, created once per variant.
+        Parameters:
+        - model: model class with json_schema() method
+        - variant: json_schema() arguments
+        Returns:
+        - jsonschema validator object
+    """
+    key = (model, tuple(sorted(variant.items())))
+    validator = _validators.get(key)
+    if validator is None:
+        schema = model.json_schema(**variant)
+        cls = validators.validator_for(schema)
+        cls.check_schema(schema)
+        validator = _validators[key] = cls(schema)
+    return validator
+
+def compile_validators():
+    """ Compile the validators of REQUEST_SCHEMAS, called at app start """
+    for model, variant in REQUEST_SCHEMAS:
+        schema_validator(model, **variant)
+
+def validate_json(instance, model, **variant):
+    """
+    Validate request JSON against the model's schema with the compiled validator.
+    Raises the same ValidationError as jsonschema.validate().
+    """
+    error = best_match(schema_validator(model, **variant).iter_errors(instance))
+    if error is not None:
+        raise error
+
 def send_local_file(filename):
     """
     Return local file content in response.
@@ -34,6 +82,170 @@ def send_local_file(filename):
     hdrs = {"Content-type": content_type}
     return Response(body, status = 200, headers=hdrs)
 
+def query_parameter(name, default, convert=int, minimum=None, maximum=None):
+    """
+    Read an optional URL query parameter of the current request.
+        Parameters:
+        - name: parameter name
+        - default: value if the parameter is not given
+        - convert: conversion function, e.g. int or float
+        - minimum, maximum: optional allowed range
+        Returns:
+        - converted parameter value or default
+        Raises:
+        - ValueError if the value is invalid or out of range
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        value = convert(value)
+    except (TypeError, ValueError) as exception:
+        raise ValueError("Invalid value for query parameter " + name) from exception
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise ValueError("Query parameter " + name + " out of range [" +\
+                         str(minimum) + ", " + str(maximum) + "]")
+    return value
+
+def encode_cursor(direction, key):
+    """
+    Create an opaque page cursor for keyset pagination.
+        Parameters:
+        - direction: "next" (rows after key) or "prev" (rows before key)
+        - key: list of the ordering column values of the boundary row
+        Returns:
+        - URL-safe cursor string
+    """
+    data = json.dumps([direction, list(key)], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def decode_cursor(cursor, key_types):
+    """
+    Decode a page cursor created by encode_cursor().
+        Parameters:
+        - cursor: cursor string from the request
+        - key_types: expected types of the key values, e.g. (int, str)
+        Returns:
+        - (direction, key)
+        Raises:
+        - ValueError if the cursor is invalid
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        direction, key = json.loads(data)
+    except (TypeError, ValueError) as exception:
+        raise ValueError("Invalid page cursor") from exception
+    if direction not in ("next", "prev") or not isinstance(key, list) or\
+       len(key) != len(key_types) or\
+       not all(isinstance(value, typ) for value, typ in zip(key, key_types)):
+        raise ValueError("Invalid page cursor")
+    return direction, key
+
+def page_parameters(key_types):
+    """
+    Read keyset pagination query parameters limit and cursor. The limit
+    must not exceed app config MAX_PAGE_SIZE, see page_size().
+        Parameters:
+        - key_types: expected types of the cursor key values
+        Returns:
+        - (limit or None, direction, key or None)
+        Raises:
+        - ValueError if a parameter is invalid
+    """
+    limit = query_parameter("limit", None, int, 1, current_app.config["MAX_PAGE_SIZE"])
+    cursor = request.args.get("cursor")
+    if cursor is None:
+        return limit, "next", None
+    direction, key = decode_cursor(cursor, key_types)
+    return limit, direction, key
+
+def page_size(limit):
+    """ Rows on a page: the requested limit, MAX_PAGE_SIZE without one """
+    return limit if limit is not None else current_app.config["MAX_PAGE_SIZE"]
+
+def page_links(direction, key, more):
+    """
+    Neighbour pages of a keyset page.
+        Parameters:
+        - direction, key: page_parameters() of the page
+        - more: True if there were more rows in the page direction
+        Returns:
+        - (has previous page, has next page)
+    """
+    # more rows before the page when paging forward from a cursor, and vice versa
+    if direction == "next":
+        return key is not None, more
+    return more, True
+
+def keyset_page(query, columns, limit, direction="next", key=None):
+    """
+    Read a page of a query with keyset pagination, ordered by the given
+    columns (ascending). Only the page rows (and one more) are read.
+        Parameters:
+        - query: SQLAlchemy query of the collection
+        - columns: ordering columns, unique together
+        - limit: page size
+        - direction: "next" for rows after key, "prev" for rows before key
+        - key: column values of the page boundary row, None for first page
+        Returns:
+        - (list of rows, True if more rows in page direction)
+    """
+    if key is not None:
+        condition = None
+        for column, value in reversed(list(zip(columns, key))):
+            beyond = column > value if direction == "next" else column < value
+            condition = beyond if condition is None else\
+                        or_(beyond, and_(column == value, condition))
+        query = query.filter(condition)
+    if direction == "next":
+        query = query.order_by(*columns)
+    else:
+        query = query.order_by(*[column.desc() for column in columns])
+    rows = query.limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "prev":
+        rows.reverse()
+    return rows, more
+
+def compact_request():
+    """
+    Check whether the compact representation is requested, either with
+    query parameter compact=1 or with Accept: application/vnd.mason+json;
+    profile="compact". Compact collections have the shared controls at the
+    collection level only and items with sparse fieldsets.
+    """
+    if request.args.get(COMPACT) == "1":
+        return True
+    for value in request.headers.get("Accept", "").split(","):
+        mimetype, options = parse_options_header(value)
+        if mimetype == MASON and options.get("profile") == COMPACT:
+            return True
+    return False
+
+def compact_args():
+    """ Compact representation query parameters of the request, for page controls """
+    return {name: request.args.get(name) for name in (COMPACT, "fields")}
+
+def compact_fields(available):
+    """
+    Read sparse fieldset query parameter fields of a compact collection.
+        Parameters:
+        - available: list of item fields sent by default
+        Returns:
+        - list of item fields to send
+        Raises:
+        - ValueError if an unknown field is requested
+    """
+    value = request.args.get("fields")
+    if value is None:
+        return available
+    fields = value.split(",")
+    for field in fields:
+        if field not in available:
+            raise ValueError("Unknown field " + field + " in query parameter fields")
+    return fields
+
 def debug_print(msg):
     """
     Debug function to print the given message to the console.
@@ -62,15 +274,27 @@ def error_response(status, title, msg=None):
     data.add_control("profile", href=ERROR_PROFILE)
     return Response(json.dumps(data), status, mimetype=MASON)
 
+def request_api_key():
+    """
+    API-key of the current request from the key cache.
+        Returns:
+        - keycache.CachedKey (also stored in flask.g.api_key) or None if
+          the key is missing or unknown
+    """
+    key = request.headers.get(SPORTBET_API_KEY_NAME)
+    if key is None:
+        return None
+    g.api_key = keycache.lookup(ApiKey.key_hash(key.strip()))
+    return g.api_key
+
 def require_admin_key(func):
     """
-    Admin API-key validation wrapper function - not used currently.
-    To be used for admin API functionality in the future versions of API.
+    Admin API-key validation wrapper function for the admin API functionality,
+    e.g. batch game result updates. Admin keys are not rate limited.
     """
     def wrapper(*args, **kwargs):
-        key_hash = ApiKey.key_hash(request.headers.get(SPORTBET_API_KEY_NAME, "").strip())
-        db_key = ApiKey.query.filter_by(admin=True).first()
-        if secrets.compare_digest(key_hash, db_key.key):
+        api_key = request_api_key()
+        if api_key is not None and api_key.admin:
             return func(*args, **kwargs)
         raise Forbidden
     return wrapper
@@ -81,7 +305,11 @@ def validate_api_key(func):
     be protected from the outsiders.
 
     API-key is created by admin with click command "flask db-fill", save the
-    printed key for client software.
+    printed key for client software. Keys are looked up from the in-process
+    key cache, so a warm cache needs no database queries.
+
+    Requests are rate limited per key and resource class (see ratelimit.py),
+    429 with Retry-After header is returned when the limit is exceeded.
 
     NOTE: enable/disable for testing (browser usually) by commenting/un-commenting
           the line "return func(self, *args, **kwargs)"
@@ -89,11 +317,15 @@ def validate_api_key(func):
     def wrapper(self, *args, **kwargs):
         # Enable browser testing by uncommenting next line
         # return func(self, *args, **kwargs)
-        if SPORTBET_API_KEY_NAME in request.headers:
-            key_hash = ApiKey.key_hash(request.headers.get(SPORTBET_API_KEY_NAME).strip())
-            db_key = ApiKey.query.filter_by(admin=False).first()
-            if db_key is not None and secrets.compare_digest(key_hash, db_key.key):
-                return func(self, *args, **kwargs)
+        api_key = request_api_key()
+        if api_key is not None and not api_key.admin:
+            retry_after = ratelimit.check(api_key, self)
+            if retry_after:
+                resp = error_response(429, "Too many requests",
+                                      "Retry after " + str(retry_after) + " seconds")
+                resp.headers["Retry-After"] = str(retry_after)
+                return resp
+            return func(self, *args, **kwargs)
         raise Forbidden
     return wrapper
 
@@ -101,39 +333,32 @@ def validate_api_key(func):
 #-------------------------------- CONVERTERS -------------------------------
 # Convert string-identifier <--> Python database object.
 # Registered in __init.py__ for resources using object identifiers in URLs.
+# URL names are resolved into objects before the view, members and games
+# within the URL's event. See identity.py for the lookups and their caches.
 #---------------------------------------------------------------------------
 
 class EventConverter(BaseConverter):
     """Conversions between Event object and Event name"""
     def to_python(self, value):
-        db_obj = Event.query.filter_by(name=value).first()
-        if db_obj is None:
-            raise NotFound
-        return db_obj
+        return identity.UrlName(Event, value)
     def to_url(self, value):
-        return value.name
+        return quote_segment(value.name)
 
 class GameConverter(BaseConverter):
     """Conversions between Game object and Game name"""
     def to_python(self, value):
-        db_obj = Game.query.filter_by(game_nbr=value).first()
-        if db_obj is None:
-            raise NotFound
-        return db_obj
+        return identity.UrlName(Game, value)
     def to_url(self, value):
-        return value.game_nbr
+        return quote_segment(value.game_nbr)
 
 class MemberConverter(BaseConverter):
     """Conversions between Member object and Member name"""
     def to_python(self, value):
-        db_obj = Member.query.filter_by(nickname=value).first()
-        if db_obj is None:
-            raise NotFound
-        return db_obj
+        return identity.UrlName(Member, value)
     def to_url(self, value):
         if value is None:
             return ""
-        return value.nickname
+        return quote_segment(value.nickname)
 
 # ----------------- MASON BUILDERS ------------------------------------
 # Base class MasonBuilder has been copied from:
@@ -241,6 +466,33 @@ class MasonBuilder(dict):
             schema=schema
         )
 
+    def add_control_pages(self, endpoint, values, limit, page, first_key, last_key):
+        """
+        Utility method for adding keyset pagination controls "next", "prev"
+        and "first" to a collection page.
+
+        : param str endpoint: endpoint of the collection resource
+        : param dict values: url_for() values of the collection resource
+        : param int limit: page size
+        : param tuple page: (has previous page, has next page), see page_links()
+        : param list first_key: ordering key of the first item on the page
+        : param list last_key: ordering key of the last item on the page
+        """
+
+        has_prev, has_next = page
+        if has_next:
+            self.add_control("next",
+                             url_for(endpoint, **values, limit=limit,
+                                     cursor=encode_cursor("next", last_key)),
+                             title="Next page")
+        if has_prev:
+            self.add_control("prev",
+                             url_for(endpoint, **values, limit=limit,
+                                     cursor=encode_cursor("prev", first_key)),
+                             title="Previous page")
+            self.add_control("first", url_for(endpoint, **values, limit=limit),
+                             title="First page")
+
     def add_control_delete(self, title, href):
         """
         Utility method for adding PUT type controls. The control is
@@ -269,44 +521,51 @@ class SportbetBuilder(MasonBuilder):
         """ Go to event list """
         self.add_control(
             SPORTBET_NAMESPACE + ":events-all",
-            url_for("api.eventcollection"),
+            urltemplates.href("api.eventcollection"),
             title="All events"
         )
     def add_control_single_event(self, event):
         """ Go to given event """
         self.add_control(
             SPORTBET_NAMESPACE + ":event-" + event.name,
-            url_for("api.eventitem", event=event),
+            urltemplates.href("api.eventitem", event=event),
             title="Event " + event.name
         )
     def add_control_all_games(self, event):
         """ Go to games list """
         self.add_control(
             SPORTBET_NAMESPACE + ":games-all",
-            url_for("api.gamecollection", event=event),
+            urltemplates.href("api.gamecollection", event=event),
             title="Games in " + event.name
         )
     def add_control_single_game(self, event, game):
         """ Go to single game """
         self.add_control(
             SPORTBET_NAMESPACE + ":game-" + game.game_nbr,
-            url_for("api.gameitem", event=event, game=game),
+            urltemplates.href("api.gameitem", event=event, game=game),
             title="Game #" + game.game_nbr
         )
     def add_control_all_bets(self, event):
         """ Go to all event bets """
         self.add_control(
             SPORTBET_NAMESPACE + ":bets-all",
-            url_for("api.betsall", event=event),
+            urltemplates.href("api.betsall", event=event),
             title="Bets in " + event.name
         )
     def add_control_member_bets(self, event, member):
         """ Go to single member's bets """
         self.add_control(
             SPORTBET_NAMESPACE + ":bets", #-" + member.nickname,
-            url_for("api.betsmember", event=event, member=member),
+            urltemplates.href("api.betsmember", event=event, member=member),
             title=member.nickname + " bets in " + event.name
         )
+    def add_control_game_stats(self, event, game):
+        """ Go to single game's bet distribution statistics """
+        self.add_control(
+            SPORTBET_NAMESPACE + ":game-stats",
+            urltemplates.href("api.gamestats", event=event, game=game),
+            title="Bet statistics for game-" + game.game_nbr
+        )
     def add_control_game_bets(self, event, game):
         """ Go to single game's bets """
         control_name = ":bets-all"
@@ -317,23 +576,30 @@ class SportbetBuilder(MasonBuilder):
             control_name = ":bets-game-" + game.game_nbr
         self.add_control(
             SPORTBET_NAMESPACE + control_name,
-            url_for("api.betsall", event=event, game=game),
+            urltemplates.href("api.betsall", event=event, game=game),
             title=title
         )
     def add_control_all_members(self, event):
         """ Go to all members """
         self.add_control(
             SPORTBET_NAMESPACE + ":members-all",
-            url_for("api.membercollection", event=event),
+            urltemplates.href("api.membercollection", event=event),
             title="Members in " + event.name
         )
     def add_control_single_member(self, event, member):
         """ Go to single member """
         self.add_control(
             SPORTBET_NAMESPACE + ":member-" + member.nickname,
-            url_for("api.memberitem", event=event, member=member),
+            urltemplates.href("api.memberitem", event=event, member=member),
             title="Member " + member.nickname
         )
+    def add_control_projection(self, event):
+        """ Go to projected betting status """
+        self.add_control(
+            SPORTBET_NAMESPACE + ":status-projection",
+            urltemplates.href("api.betstatusprojection", event=event),
+            title="Projected betting status " + event.name
+        )
     def add_control_betting_status(self, event, member):
         """ Go to betting status for whole event or single member """
         control_name = ":status-all"
@@ -343,7 +609,7 @@ class SportbetBuilder(MasonBuilder):
             control_name = ":status-" + member.nickname
         self.add_control(
             SPORTBET_NAMESPACE + control_name,
-            url_for("api.betstatus", event=event, member=member),
+            urltemplates.href("api.betstatus", event=event, member=member),
             title=title
         )
 
@@ -352,13 +618,13 @@ class SportbetBuilder(MasonBuilder):
         """ Delete given game """
         self.add_control_delete(
             "Delete game",
-            url_for("api.gameitem", event=event, game=game)
+            urltemplates.href("api.gameitem", event=event, game=game)
         )
     def add_control_delete_member(self, event, member):
         """ Delete given member """
         self.add_control_delete(
             "Delete member",
-            url_for("api.memberitem", event=event, member=member)
+            urltemplates.href("api.memberitem", event=event, member=member)
         )
 
     # POST controls to add items
@@ -367,7 +633,7 @@ class SportbetBuilder(MasonBuilder):
         self.add_control_post(
             SPORTBET_NAMESPACE + ":add-member",
             "Add member to " + event.name,
-            url_for("api.membercollection", event=event),
+            urltemplates.href("api.membercollection", event=event),
             Member.json_schema()
         )
     def add_control_add_game(self, event):
@@ -375,7 +641,7 @@ class SportbetBuilder(MasonBuilder):
         self.add_control_post(
             SPORTBET_NAMESPACE + ":add-game",
             "Add game to " + event.name,
-            url_for("api.gamecollection", event=event),
+            urltemplates.href("api.gamecollection", event=event),
             Game.json_schema(only_goals=False)
         )
     def add_control_add_bet(self, event, member):
@@ -383,22 +649,42 @@ class SportbetBuilder(MasonBuilder):
         self.add_control_post(
             SPORTBET_NAMESPACE + ":add-bet",
             "Add bet for " + member.nickname,
-            url_for("api.betsmember", event=event, member=member),
+            urltemplates.href("api.betsmember", event=event, member=member),
             Bet.json_schema(full_format=False)
         )
+    def add_control_add_bets(self, event, member):
+        """ Add or update many bets at once """
+        self.add_control_post(
+            SPORTBET_NAMESPACE + ":add-bets",
+            "Add or update bets for " + member.nickname,
+            urltemplates.href("api.betsbatch", event=event, member=member),
+            {"type": "array", "items": Bet.json_schema(full_format=False)}
+        )
 
     # PUT controls for editing items
     def add_control_edit_result(self, event, game):
         """ Edit existing game goals """
         self.add_control_put(
             "Edit game",
-            url_for("api.gameitem", event=event, game=game),
+            urltemplates.href("api.gameitem", event=event, game=game),
             Game.json_schema(only_goals=True)
         )
     def add_control_edit_bet(self, event, member):
         """ Edit existing bet goals """
         self.add_control_put(
             "Edit bet",
-            url_for("api.betsmember", event=event, member=member),
+            urltemplates.href("api.betsmember", event=event, member=member),
             Bet.json_schema(full_format=False)
         )
+
+    # Compact collections, see compact_request()
+    def add_control_item_template(self, href_template, title):
+        """ Href template of the items, replaces the items' own self controls """
+        self.add_control("item", href_template, title=title, isHrefTemplate=True)
+    def add_game_table(self, games):
+        """ Game table referenced by the items' game_nbr """
+        self["games"] = {}
+        for game in games:
+            fields = game.serialize()
+            del fields["game_nbr"]
+            self["games"][game.game_nbr] = fields
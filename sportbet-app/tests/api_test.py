@@ -15,19 +15,24 @@ import os
 import pytest
 import tempfile
 import time
+from flask import url_for
 from flask.testing import FlaskClient
-from jsonschema import validate
+from jsonschema import validate, ValidationError
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, update
 from werkzeug.datastructures import Headers
 
 from sportbet import create_app, db
-from sportbet.models import Event, Member, Game, Bet, ApiKey
+from sportbet.models import Event, Member, Game, Bet, ApiKey, Standing
+from sportbet import identity, projection, ranking, ratelimit, responsecache, scoring, serializer, urltemplates, utils
+from sportbet.scoring import rebuild_standings
+from sportbet.resources import bet
 
 SPORTBET_NAMESPACE = "sportbet"
 SPORTBET_API_KEY_NAME = 'Sportbet-Api-Key'
 TEST_KEY = "thisIsOnlyTestKey"
 TEST_EVENT_NAME = "Test-Bandy-MM-2024"
+MASON = "application/vnd.mason+json"
 
 # https://stackoverflow.com/questions/16416001/set-http-headers-for-all-requests-in-a-flask-test
 class AuthHeaderClient(FlaskClient):
@@ -39,6 +44,8 @@ class AuthHeaderClient(FlaskClient):
         headers = kwargs.pop('headers', Headers())
         headers.extend(api_key_headers)
         kwargs['headers'] = headers
+        # read streamed responses to the end as a server does
+        kwargs.setdefault('buffered', True)
         return super().open(*args, **kwargs)
     
 @event.listens_for(Engine, "connect")
@@ -55,7 +62,8 @@ def client():
     db_fd, db_fname = tempfile.mkstemp()
     config = {
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
-        "TESTING": True
+        "TESTING": True,
+        "CACHE_TYPE": "SimpleCache"
     }
     
     app = create_app(config)
@@ -106,6 +114,9 @@ def _populate_db():
     )
     db.session.add(db_key)        
     
+    # Materialized betting status for the populated bets
+    rebuild_standings(e)
+    
     db.session.commit()
 
 def _get_member_json(nickname="mholappa"):
@@ -388,6 +399,49 @@ class TestGameItem(object):
     def test_delete(self, client):
         _common_test_delete(client, self.RESOURCE_URL, self.INVALID_URL)
 
+class TestGameStats(object):
+
+    RESOURCE_URL = "/api/" + TEST_EVENT_NAME + "/games/2/stats/"
+    INVALID_URL = "/api/" + TEST_EVENT_NAME + "/games/666/stats/"
+
+    def test_get(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        # game2 bets from db-populate: 2-2, 4-4, 6-6
+        assert body["bets"] == 3
+        assert (body["home_win"], body["draw"], body["away_win"]) == (0, 3, 0)
+        assert body["average_home_goals"] == 4.0
+        assert body["average_guest_goals"] == 4.0
+        assert [item["score"] for item in body["top_scores"]] == ["2-2", "4-4", "6-6"]
+        _check_control_get_method("sportbet:game-2", client, body)
+        resp = client.get(self.INVALID_URL)
+        assert resp.status_code == 404
+        # game without bets
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/games/4/stats/")
+        body = json.loads(resp.data)
+        assert body["bets"] == 0
+        assert body["average_home_goals"] is None
+        assert body["top_scores"] == []
+
+    def test_bet_changes(self, client):
+        client.get(self.RESOURCE_URL)
+        # updated and new bets are seen in the cached statistics
+        client.put("/api/" + TEST_EVENT_NAME + "/bets/pohtonen/", json=_get_bet_json("2", 2, 2))
+        resp = client.get(self.RESOURCE_URL)
+        body = json.loads(resp.data)
+        assert body["top_scores"][0] == {"score": "2-2", "bets": 2}
+        client.post("/api/" + TEST_EVENT_NAME + "/members/", json=_get_member_json("newbie"))
+        client.post("/api/" + TEST_EVENT_NAME + "/bets/newbie/", json=_get_bet_json("2", 3, 1))
+        resp = client.get(self.RESOURCE_URL)
+        body = json.loads(resp.data)
+        assert (body["bets"], body["home_win"], body["draw"]) == (4, 1, 3)
+        # deleted member's bets are removed from the statistics
+        client.delete("/api/" + TEST_EVENT_NAME + "/members/newbie/")
+        resp = client.get(self.RESOURCE_URL)
+        body = json.loads(resp.data)
+        assert (body["bets"], body["home_win"]) == (3, 0)
+
 """
 BetsAll and BetsMember tests
 """      
@@ -492,6 +546,203 @@ class TestBetStatusAllCollection(object):
                                )
         _check_control_get_method("sportbet:event-" + TEST_EVENT_NAME, client, body)
 
+    def test_points(self, client):
+        # game1 1-1, game2 2-3: exact result (3), goal difference (2), no points (0)
+        resp = client.get(self.RESOURCE_URL)
+        body = json.loads(resp.data)
+        points = [(item["nickname"], item["points"]) for item in body["items"]]
+        assert points == [("mholappa", 3), ("ahilmola", 2), ("pohtonen", 2)]
+        # bet with correct winner (1) and bet for a game not played yet (0)
+        client.put("/api/" + TEST_EVENT_NAME + "/bets/pohtonen/", json=_get_bet_json("2", 0, 2))
+        client.post("/api/" + TEST_EVENT_NAME + "/bets/pohtonen/", json=_get_bet_json("4", 0, 2))
+        resp = client.get(self.RESOURCE_URL)
+        body = json.loads(resp.data)
+        points = [(item["nickname"], item["points"]) for item in body["items"]]
+        assert points == [("mholappa", 3), ("pohtonen", 3), ("ahilmola", 2)]
+
+    def test_result_changes(self, client):
+        # game2 result 2-2: all bets on game2 are draws
+        client.put("/api/" + TEST_EVENT_NAME + "/games/2/", json=_get_game_json("2"))
+        resp = client.get(self.RESOURCE_URL)
+        points = [item["points"] for item in json.loads(resp.data)["items"]]
+        assert points == [6, 4, 4]
+        # game1 and its bets removed
+        client.delete("/api/" + TEST_EVENT_NAME + "/games/1/")
+        resp = client.get(self.RESOURCE_URL)
+        points = [item["points"] for item in json.loads(resp.data)["items"]]
+        assert points == [3, 2, 2]
+        # game2 result reset to not played
+        client.put("/api/" + TEST_EVENT_NAME + "/games/2/",
+                   json={"home_goals": -1, "guest_goals": -1})
+        resp = client.get(self.RESOURCE_URL)
+        points = [item["points"] for item in json.loads(resp.data)["items"]]
+        assert points == [0, 0, 0]
+        # materialized points match the calculated ones
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["standings-rebuild", "--check"])
+        assert "0 members drifted" in result.output
+
+    def test_snapshots(self, client):
+        game_url = "/api/" + TEST_EVENT_NAME + "/games/"
+        def snapshot(game_nbr):
+            resp = client.get(self.RESOURCE_URL + "?after_game=" + game_nbr)
+            if resp.status_code != 200:
+                return resp.status_code
+            return [(item["nickname"], item["points"]) for item in json.loads(resp.data)["items"]]
+        # results for game2 (2-2) and game3 (1-1, no bets)
+        client.put(game_url + "2/", json=_get_game_json("2"))
+        client.put(game_url + "3/", json=_get_game_json("1"))
+        after_game2 = [("mholappa", 6), ("ahilmola", 4), ("pohtonen", 4)]
+        assert snapshot("2") == after_game2
+        assert snapshot("3") == after_game2
+        # game1 result not set via API, no snapshot
+        assert snapshot("1") == 404
+        # correction of game2 result and bet update for game2 update both snapshots
+        client.put(game_url + "2/", json={"home_goals": 2, "guest_goals": 3})
+        client.put("/api/" + TEST_EVENT_NAME + "/bets/pohtonen/", json=_get_bet_json("2", 0, 1))
+        assert snapshot("2") == [("pohtonen", 4), ("mholappa", 3), ("ahilmola", 2)]
+        assert snapshot("3") == [("pohtonen", 4), ("mholappa", 3), ("ahilmola", 2)]
+        # game2 result reset removes its snapshot and its points from the later ones
+        client.put(game_url + "2/", json={"home_goals": -1, "guest_goals": -1})
+        assert snapshot("2") == 404
+        assert snapshot("3") == [("mholappa", 3), ("ahilmola", 2), ("pohtonen", 2)]
+        resp = client.get(self.RESOURCE_URL)
+        assert [(item["nickname"], item["points"]) for item in json.loads(resp.data)["items"]] ==\
+            snapshot("3")
+
+    def test_snapshot_member_deleted(self, client):
+        members_url = "/api/" + TEST_EVENT_NAME + "/members/"
+        client.post(members_url, json=_get_member_json("zed"))
+        client.post("/api/" + TEST_EVENT_NAME + "/bets/zed/", json=_get_bet_json("4", 2, 0))
+        client.put("/api/" + TEST_EVENT_NAME + "/games/4/", json={"home_goals": 2, "guest_goals": 0})
+        resp = client.get(self.RESOURCE_URL + "?after_game=4")
+        assert ("zed", 3) in [(item["nickname"], item["points"])
+                              for item in json.loads(resp.data)["items"]]
+        # a member added after the delete may get the same id, not the old points
+        client.delete(members_url + "zed/")
+        client.post(members_url, json=_get_member_json("newbie"))
+        resp = client.get(self.RESOURCE_URL + "?after_game=4")
+        nicknames = [item["nickname"] for item in json.loads(resp.data)["items"]]
+        assert "zed" not in nicknames
+        assert "newbie" not in nicknames
+
+    def test_pages(self, client):
+        # points: mholappa 3, ahilmola 2, pohtonen 2 (equal points ordered by nickname)
+        resp = client.get(self.RESOURCE_URL + "?limit=2")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["nickname"] for item in body["items"]] == ["mholappa", "ahilmola"]
+        assert "prev" not in body["@controls"]
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["nickname"] for item in body["items"]] == ["pohtonen"]
+        assert "next" not in body["@controls"]
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["nickname"] for item in body["items"]] == ["mholappa", "ahilmola"]
+        assert "prev" not in body["@controls"]
+        assert "next" in body["@controls"]
+        # top-N of a snapshot
+        client.put("/api/" + TEST_EVENT_NAME + "/games/2/", json=_get_game_json("2"))
+        resp = client.get(self.RESOURCE_URL + "?after_game=2&limit=1")
+        body = json.loads(resp.data)
+        assert [item["nickname"] for item in body["items"]] == ["mholappa"]
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["nickname"] for item in body["items"]] == ["ahilmola"]
+        # invalid limit and cursor
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?cursor=invalid")
+        assert resp.status_code == 400
+
+    def test_event_rules(self, client):
+        scoring.register_rules("test-rules", exact=5, goal_difference=3, winner=1)
+        with client.application.app_context():
+            db.session.get(Event, 1).scoring = "test-rules"
+            db.session.commit()
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["standings-rebuild"])
+        assert "3 members drifted, rebuilt" in result.output
+        resp = client.get(self.RESOURCE_URL)
+        points = [item["points"] for item in json.loads(resp.data)["items"]]
+        assert points == [5, 3, 3]
+        resp = client.get(self.RESOURCE_URL + "mholappa/")
+        points = [item["points"] for item in json.loads(resp.data)["items"]]
+        assert points == [5, 0]
+
+"""
+Projected BetStatus tests
+"""
+class TestBetStatusProjection(object):
+
+    RESOURCE_URL = "/api/" + TEST_EVENT_NAME + "/projection/"
+    INVALID_URL = "/api/" + TEST_EVENT_NAME + "/projectionx/"
+
+    def test_get(self, client):
+        body = _common_test_get(client,
+                                self.RESOURCE_URL,
+                                self.INVALID_URL,
+                                None,
+                                3, # member count from db-populate
+                                None,
+                               )
+        _check_control_get_method("sportbet:status-all", client, body)
+        # no bets for the only remaining game (4): current leader wins
+        assert body["remaining_games"] == 1
+        assert body["method"] == "enumeration"
+        assert body["items"][0]["nickname"] == "mholappa"
+        assert body["items"][0]["win_probability"] == 1.0
+
+    def test_member_named_projection(self, client):
+        client.post("/api/" + TEST_EVENT_NAME + "/members/", json=_get_member_json("projection"))
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/betstatus/projection/")
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["nickname"] == "projection"
+
+    def test_sampling(self, client):
+        client.post("/api/" + TEST_EVENT_NAME + "/bets/pohtonen/", json=_get_bet_json("4", 1, 0))
+        resp = client.get(self.RESOURCE_URL + "?samples=100&seed=1&distribution=uniform&max_goals=10")
+        body = json.loads(resp.data)
+        assert body["method"] == "sampling"
+        assert body["scenarios"] == 100
+        assert body["complete"]
+        items = {item["nickname"]: item for item in body["items"]}
+        assert items["pohtonen"]["max_points"] == 5
+        assert items["ahilmola"]["win_probability"] == 0.0
+        assert 0.0 < items["pohtonen"]["win_probability"] < 1.0
+        assert sum(item["win_probability"] for item in body["items"]) == pytest.approx(1.0, abs=0.001)
+        resp = client.get(self.RESOURCE_URL + "?distribution=normal")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?samples=0")
+        assert resp.status_code == 400
+
+    def test_enumeration_timeout(self, client, monkeypatch):
+        # partial enumeration is not used, the scenarios are sampled instead
+        monkeypatch.setattr(projection, "_enumerate",
+                            lambda current, *args: ([1.0] + [0.0] * (len(current) - 1), 1.0, False))
+        client.post("/api/" + TEST_EVENT_NAME + "/bets/pohtonen/", json=_get_bet_json("4", 1, 0))
+        resp = client.get(self.RESOURCE_URL + "?seed=1&distribution=uniform&max_goals=10")
+        body = json.loads(resp.data)
+        assert body["method"] == "sampling"
+        assert body["complete"]
+        items = {item["nickname"]: item for item in body["items"]}
+        assert 0.0 < items["pohtonen"]["win_probability"] < 1.0
+
+    def test_sampling_workers(self, client):
+        client.post("/api/" + TEST_EVENT_NAME + "/bets/pohtonen/", json=_get_bet_json("4", 1, 0))
+        url = self.RESOURCE_URL + "?samples=100&seed=1&distribution=uniform&max_goals=10"
+        single = json.loads(client.get(url).data)
+        # sampled in a process pool of two spawned workers (other seed, not a cached response)
+        client.application.config["PROJECTION_WORKERS"] = 2
+        body = json.loads(client.get(url.replace("seed=1", "seed=2")).data)
+        assert body["method"] == "sampling"
+        assert body["scenarios"] == 100
+        assert body["complete"]
+        assert sum(item["win_probability"] for item in body["items"]) == pytest.approx(1.0, abs=0.001)
+        assert [item["nickname"] for item in body["items"]] ==\
+            [item["nickname"] for item in single["items"]]
+
 """
 BetStatus for a single member tests
 """      
@@ -511,3 +762,804 @@ class TestBetStatusMemberCollection(object):
                                )
         _check_control_get_method("sportbet:event-" + TEST_EVENT_NAME, client, body)
         _check_control_get_method("sportbet:status-all", client, body)
+
+    def test_points(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        body = json.loads(resp.data)
+        assert body["items"] == [{"game_nbr": "1", "points": 3, "result": "1-1", "bet": "1-1"},
+                                 {"game_nbr": "2", "points": 0, "result": "2-3", "bet": "2-2"}]
+
+    def test_rank(self, client):
+        url = "/api/" + TEST_EVENT_NAME + "/betstatus/pohtonen/"
+        body = json.loads(client.get(url).data)
+        assert (body["points"], body["rank"], body["members"], body["gap_to_leader"]) == (2, 2, 3, 1)
+        # correct winner for game2 (+1): shared first place
+        client.put("/api/" + TEST_EVENT_NAME + "/bets/pohtonen/", json=_get_bet_json("2", 0, 2))
+        body = json.loads(client.get(url).data)
+        assert (body["points"], body["rank"], body["gap_to_leader"]) == (3, 1, 0)
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert (body["points"], body["rank"], body["gap_to_leader"]) == (3, 1, 0)
+        # game1 result change: mholappa loses exact result, ahilmola gets it
+        client.put("/api/" + TEST_EVENT_NAME + "/games/1/", json={"home_goals": 5, "guest_goals": 5})
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert (body["points"], body["rank"], body["gap_to_leader"]) == (2, 3, 1)
+        client.delete("/api/" + TEST_EVENT_NAME + "/members/ahilmola/")
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert (body["points"], body["rank"], body["members"], body["gap_to_leader"]) == (2, 2, 2, 1)
+
+    def test_rank_incremental(self, client, monkeypatch):
+        url = "/api/" + TEST_EVENT_NAME + "/betstatus/pohtonen/"
+        builds = []
+        build = ranking._build
+        def count_build(*args):
+            builds.append(args)
+            return build(*args)
+        monkeypatch.setattr(ranking, "_build", count_build)
+        client.get(url)
+        # bet updates of this process are applied to the index, no rebuilds
+        for goals in range(5):
+            client.put("/api/" + TEST_EVENT_NAME + "/bets/pohtonen/",
+                       json=_get_bet_json("2", 4 - goals, 2))
+            body = json.loads(client.get(url).data)
+        assert len(builds) == 1
+        assert (body["points"], body["rank"], body["gap_to_leader"]) == (3, 1, 0)
+
+    def test_rank_changes_elsewhere(self, client):
+        url = "/api/" + TEST_EVENT_NAME + "/betstatus/pohtonen/"
+        body = json.loads(client.get(url).data)
+        assert (body["rank"], body["gap_to_leader"]) == (2, 1)
+        # another process raises mholappa's points and bumps the shared generation
+        with client.application.app_context():
+            test_event = Event.query.filter_by(name=TEST_EVENT_NAME).first()
+            member = Member.query.filter_by(nickname="mholappa").first()
+            db.session.execute(update(Standing).where(Standing.member_id == member.id)
+                               .values(points=10))
+            db.session.commit()
+            responsecache.bump(test_event.id)
+        body = json.loads(client.get(url).data)
+        assert (body["points"], body["rank"], body["gap_to_leader"]) == (2, 2, 8)
+
+"""
+Batch bet scorer tests (vectorized and pure Python fallback)
+"""
+def _reference_points(bet_home, bet_guest, game_home, game_guest, exact=3, difference=2, winner=1):
+    """ Point rules written out with branches, to verify the compiled lookup table """
+    if game_home < 0:
+        return 0
+    if bet_home == game_home and bet_guest == game_guest:
+        return exact
+    if (bet_home - bet_guest) == (game_home - game_guest):
+        return difference
+    if game_home > game_guest and bet_home > bet_guest:
+        return winner
+    if game_home < game_guest and bet_home < bet_guest:
+        return winner
+    return 0
+
+class TestScoreBatch(object):
+
+    GOALS = range(-1, 5)
+
+    def _check_batch(self):
+        bets = [(bh, bg, gh, gg) for bh in self.GOALS for bg in self.GOALS
+                for gh in self.GOALS for gg in self.GOALS]
+        expected = [_reference_points(*bet) for bet in bets]
+        assert [scoring.bet_points(*bet) for bet in bets] == expected
+        points = scoring.score_batch(*zip(*bets))
+        assert [int(pts) for pts in points] == expected
+        rules = scoring.ScoringRules("test", exact=5, goal_difference=3, winner=2)
+        expected = [_reference_points(*bet, 5, 3, 2) for bet in bets]
+        points = scoring.score_batch(*zip(*bets), rules)
+        assert [int(pts) for pts in points] == expected
+
+    def test_score_batch(self):
+        self._check_batch()
+
+    def test_score_batch_fallback(self, monkeypatch):
+        monkeypatch.setattr(scoring, "np", None)
+        self._check_batch()
+
+"""
+API key cache tests
+"""
+class TestApiKeyCache(object):
+
+    RESOURCE_URL = "/api/events/"
+
+    def test_no_queries_when_warm(self, client):
+        queries = []
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            queries.append(statement)
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", count_query)
+        try:
+            client.get(self.RESOURCE_URL)
+            cold = len(queries)
+            queries.clear()
+            client.get(self.RESOURCE_URL)
+            assert len(queries) < cold
+            assert not any("api_key" in statement for statement in queries)
+        finally:
+            event.remove(engine, "before_cursor_execute", count_query)
+
+    def test_invalidation(self, client):
+        app = client.application
+        new_client = FlaskClient(app, app.response_class)
+        new_headers = {SPORTBET_API_KEY_NAME: "newTestKey"}
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        resp = new_client.get(self.RESOURCE_URL, headers=new_headers)
+        assert resp.status_code == 403
+        # added key is accepted and removed key rejected right after commit
+        with app.app_context():
+            db.session.add(ApiKey(key=ApiKey.key_hash("newTestKey"), admin=False))
+            db.session.delete(db.session.get(ApiKey, ApiKey.key_hash(TEST_KEY)))
+            db.session.commit()
+        resp = new_client.get(self.RESOURCE_URL, headers=new_headers)
+        assert resp.status_code == 200
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 403
+
+    def test_unknown_key_not_cached(self, client):
+        app = client.application
+        new_client = FlaskClient(app, app.response_class)
+        new_headers = {SPORTBET_API_KEY_NAME: "unknownKey"}
+        queries = []
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            queries.append(statement)
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", count_query)
+        try:
+            # random keys do not fill the cache, each one is looked up
+            for _ in range(2):
+                queries.clear()
+                resp = new_client.get(self.RESOURCE_URL, headers=new_headers)
+                assert resp.status_code == 403
+                assert any("api_key" in statement for statement in queries)
+        finally:
+            event.remove(engine, "before_cursor_execute", count_query)
+
+"""
+Rate limiting tests
+"""
+class TestRateLimit(object):
+
+    RESOURCE_URL = "/api/" + TEST_EVENT_NAME + "/betstatus/"
+
+    def _set_key_limit(self, client, limit):
+        with client.application.app_context():
+            db.session.get(ApiKey, ApiKey.key_hash(TEST_KEY)).rate_limit = limit
+            db.session.commit()
+
+    def test_key_limit(self, client):
+        self._set_key_limit(client, 2)
+        for _ in range(2):
+            resp = client.get(self.RESOURCE_URL)
+            assert resp.status_code == 200
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 429
+        assert 1 <= int(resp.headers["Retry-After"]) <= 30
+        body = json.loads(resp.data)
+        assert "@error" in body
+        # buckets are per resource class
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/games/")
+        assert resp.status_code == 200
+
+    def test_shared_store(self, client):
+        store_fd, store_fname = tempfile.mkstemp()
+        client.application.config["RATE_LIMIT_STORE"] = store_fname
+        self._set_key_limit(client, 2)
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        # another worker process sharing the store file takes the last token
+        other = ratelimit.SqliteBucketStore(store_fname)
+        bucket = client.application.config["SQLALCHEMY_DATABASE_URI"] +\
+                 "|" + ApiKey.key_hash(TEST_KEY).hex() + "|BetStatus"
+        assert other.take(bucket, 2, time.time()) == 0
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 429
+        os.close(store_fd)
+
+"""
+URL converter lookup tests
+"""
+class TestConverters(object):
+
+    RESOURCE_URL = "/api/" + TEST_EVENT_NAME + "/members/mholappa/"
+
+    def test_warm_lookup(self, client):
+        queries = []
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            queries.append(statement)
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", count_query)
+        try:
+            client.get(self.RESOURCE_URL)
+            assert any("event.name =" in statement for statement in queries)
+            assert any("member.nickname =" in statement for statement in queries)
+            queries.clear()
+            resp = client.get(self.RESOURCE_URL)
+            assert resp.status_code == 200
+            assert not any("event.name =" in statement for statement in queries)
+            assert not any("member.nickname =" in statement for statement in queries)
+            # member and its event by primary key in one statement
+            assert len(queries) == 1
+        finally:
+            event.remove(engine, "before_cursor_execute", count_query)
+
+    def test_event_scope(self, client):
+        with client.application.app_context():
+            other = Event(name="Other-Event")
+            other.games.append(Game(game_nbr="99", home_team="A", guest_team="B",
+                                    home_goals=-1, guest_goals=-1))
+            db.session.add(other)
+            db.session.commit()
+        resp = client.get("/api/Other-Event/games/99/")
+        assert resp.status_code == 200
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/games/99/")
+        assert resp.status_code == 404
+        assert json.loads(resp.data)["@error"]["@message"] == "Game not found"
+        resp = client.get("/api/No-Event/games/99/")
+        assert resp.status_code == 404
+        assert json.loads(resp.data)["@error"]["@message"] == "Event not found"
+
+    def test_changes(self, client):
+        game_url = "/api/" + TEST_EVENT_NAME + "/games/1/"
+        client.get(game_url)
+        client.put(game_url, json={"home_goals": 5, "guest_goals": 0})
+        body = json.loads(client.get(game_url).data)
+        assert (body["home_goals"], body["guest_goals"]) == (5, 0)
+        client.get(self.RESOURCE_URL)
+        client.delete(self.RESOURCE_URL)
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 404
+
+    def test_changes_elsewhere(self, client):
+        game_url = "/api/" + TEST_EVENT_NAME + "/games/1/"
+        client.get(game_url)
+        # result changed by another process, the cached lookup loads the current values
+        with client.application.app_context():
+            db.session.execute(update(Game).where(Game.game_nbr == "1")
+                               .values(home_goals=5, guest_goals=0))
+            rebuild_standings(Event.query.filter_by(name=TEST_EVENT_NAME).first())
+            db.session.commit()
+        resp = client.put(game_url, json={"home_goals": 1, "guest_goals": 1})
+        assert resp.status_code == 204
+        with client.application.app_context():
+            game = Game.query.filter_by(game_nbr="1").first()
+            assert (game.home_goals, game.guest_goals) == (1, 1)
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["standings-rebuild", "--check"])
+        assert "0 members drifted" in result.output
+
+"""
+Database upgrade tests
+"""
+class TestDbUpgrade(object):
+
+    def test_upgrade(self, client):
+        # bet table of an older version without (member, game) uniqueness and
+        # with a duplicated bet
+        with client.application.app_context():
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+                conn.exec_driver_sql("CREATE TABLE old_bet (id INTEGER NOT NULL, "
+                                     "game_id INTEGER, member_id INTEGER, "
+                                     "home_goals INTEGER NOT NULL, guest_goals INTEGER NOT NULL, "
+                                     "PRIMARY KEY (id))")
+                conn.exec_driver_sql("INSERT INTO old_bet SELECT * FROM bet")
+                conn.exec_driver_sql("DROP TABLE bet")
+                conn.exec_driver_sql("ALTER TABLE old_bet RENAME TO bet")
+                conn.exec_driver_sql("INSERT INTO bet (game_id, member_id, home_goals, guest_goals) "
+                                     "SELECT game_id, member_id, 1, 1 FROM bet WHERE id = 1")
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["db-upgrade"])
+        assert "bet: table rebuilt" in result.output
+        assert "bet: index ix_bet_game_id created" in result.output
+        result = runner.invoke(args=["db-upgrade"])
+        assert result.output == "Database upgraded\n"
+        # latest of the duplicated bets kept
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/bets/")
+        assert len(json.loads(resp.data)["items"]) == 6
+        with client.application.app_context():
+            bet = Bet.query.filter_by(member_id=1, game_id=1).one()
+            assert (bet.home_goals, bet.guest_goals) == (1, 1)
+
+    def test_event_scoped_names(self, client):
+        with client.application.app_context():
+            other = Event(name="Other-Event")
+            other.members.append(Member(nickname="mholappa"))
+            other.games.append(Game(game_nbr="1", home_team="A", guest_team="B",
+                                    home_goals=-1, guest_goals=-1))
+            db.session.add(other)
+            db.session.commit()
+        resp = client.post("/api/" + TEST_EVENT_NAME + "/members/", json=_get_member_json())
+        assert resp.status_code == 409
+
+"""
+Response cache tests
+"""
+class TestResponseCache(object):
+
+    RESOURCE_URL = "/api/" + TEST_EVENT_NAME + "/members/"
+
+    def test_hits_and_writes(self, client):
+        counters = responsecache.counters()
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.headers["X-Cache"] == "MISS"
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.headers["X-Cache"] == "HIT"
+        assert len(json.loads(resp.data)["items"]) == 3
+        assert responsecache.counters()["hit"] == counters["hit"] + 1
+        assert responsecache.counters()["miss"] == counters["miss"] + 1
+        # query string is part of the key
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/betstatus/?limit=1")
+        assert resp.headers["X-Cache"] == "MISS"
+        assert len(json.loads(resp.data)["items"]) == 1
+        # every write starts a new generation of the event
+        client.post(self.RESOURCE_URL, json=_get_member_json("newbie"))
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.headers["X-Cache"] == "MISS"
+        assert len(json.loads(resp.data)["items"]) == 4
+        client.get("/api/" + TEST_EVENT_NAME + "/betstatus/")
+        client.put("/api/" + TEST_EVENT_NAME + "/games/2/", json=_get_game_json("2"))
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/betstatus/")
+        assert resp.headers["X-Cache"] == "MISS"
+        assert [item["points"] for item in json.loads(resp.data)["items"]] == [6, 4, 4, 0]
+        # failed write does not change the generation
+        client.get(self.RESOURCE_URL)
+        resp = client.post(self.RESOURCE_URL, json=_get_member_json("newbie"))
+        assert resp.status_code == 409
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.headers["X-Cache"] == "HIT"
+
+    def test_backends(self, client):
+        assert responsecache.BACKENDS["null"] == "NullCache"
+        db_fd, db_fname = tempfile.mkstemp()
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+                          "TESTING": True,
+                          "CACHE_TYPE": "SimpleCache",
+                          "RESPONSE_CACHE_TYPE": "null"})
+        with app.app_context():
+            db.create_all()
+            _populate_db()
+        app.test_client_class = AuthHeaderClient
+        null_client = app.test_client()
+        for _ in range(2):
+            resp = null_client.get(self.RESOURCE_URL)
+            assert resp.headers["X-Cache"] == "MISS"
+        os.close(db_fd)
+
+    def test_generation_before_objects(self, client, monkeypatch):
+        game_url = "/api/" + TEST_EVENT_NAME + "/games/1/"
+        client.get(game_url)
+        resolve = identity.resolve
+        def resolve_then_write(values, goals=7):
+            missing = resolve(values)
+            # another process saves the result right after the game was loaded
+            with client.application.app_context():
+                db.session.execute(update(Game).where(Game.game_nbr == "1")
+                                   .values(home_goals=goals))
+                db.session.commit()
+                responsecache.bump(Event.query.filter_by(name=TEST_EVENT_NAME).first().id)
+            return missing
+        monkeypatch.setattr(identity, "resolve", resolve_then_write)
+        resp = client.get(game_url)
+        assert json.loads(resp.data)["home_goals"] == 1
+        monkeypatch.undo()
+        # the ETag is older than the write, the new result is not hidden by a 304
+        resp = client.get(game_url, headers=Headers({"If-None-Match": resp.headers["ETag"]}))
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["home_goals"] == 7
+        # not cached: the generation is read after the lookup and the game loaded again
+        identity.clear()
+        monkeypatch.setattr(identity, "resolve", lambda values: resolve_then_write(values, 8))
+        resp = client.get(game_url)
+        assert json.loads(resp.data)["home_goals"] == 8
+        monkeypatch.undo()
+        resp = client.get(game_url, headers=Headers({"If-None-Match": resp.headers["ETag"]}))
+        assert resp.status_code == 304
+
+    def test_conditional_get(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        # no Last-Modified within the second of the latest change
+        assert "Last-Modified" not in resp.headers
+        time.sleep(1.0)
+        resp = client.get(self.RESOURCE_URL)
+        last_modified = resp.headers["Last-Modified"]
+        resp = client.get(self.RESOURCE_URL, headers=Headers({"If-None-Match": etag}))
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+        assert resp.data == b""
+        resp = client.get(self.RESOURCE_URL, headers=Headers({"If-Modified-Since": last_modified}))
+        assert resp.status_code == 304
+        # item resources of the event share the version
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/games/1/",
+                          headers=Headers({"If-None-Match": etag}))
+        assert resp.status_code == 304
+        resp = client.get(self.RESOURCE_URL, headers=Headers({"If-None-Match": '"other"'}))
+        assert resp.status_code == 200
+        # writes change the version
+        client.put("/api/" + TEST_EVENT_NAME + "/games/1/", json=_get_game_json("2"))
+        resp = client.get(self.RESOURCE_URL, headers=Headers({"If-None-Match": etag}))
+        assert resp.status_code == 200
+        resp = client.get(self.RESOURCE_URL, headers=Headers({"If-Modified-Since": last_modified}))
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+        # event list has its own version, changed with events
+        resp = client.get("/api/events/")
+        etag = resp.headers["ETag"]
+        with client.application.app_context():
+            db.session.add(Event(name="Other-Event"))
+            db.session.commit()
+        resp = client.get("/api/events/", headers=Headers({"If-None-Match": etag}))
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)["items"]) == 2
+
+"""
+Request body schema tests
+"""
+class TestSchemas(object):
+
+    def test_memoized_schemas(self, client):
+        schema = Game.json_schema(only_goals=True)
+        assert Game.json_schema(True) is schema
+        assert Game.json_schema() is not schema
+        with pytest.raises(TypeError):
+            schema["required"].append("game_nbr")
+        with pytest.raises(TypeError):
+            schema["properties"]["home_goals"] = {}
+        # hypermedia controls share the schema
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/games/1/")
+        body = json.loads(resp.data)
+        assert body["@controls"]["sportbet:edit"]["schema"] == json.loads(json.dumps(schema))
+
+    def test_compiled_validators(self, client):
+        validator = utils.schema_validator(Bet, full_format=False)
+        assert utils.schema_validator(Bet, full_format=False) is validator
+        utils.validate_json(_get_bet_json("1", 1, 2), Bet, full_format=False)
+        with pytest.raises(ValidationError):
+            utils.validate_json({"game_nbr": "1", "home_goals": "x"}, Bet, full_format=False)
+
+class TestSerializer(object):
+
+    def test_byte_identical(self, client):
+        # quotes, spaces and non-ASCII are escaped as json.dumps() escapes them
+        resp = client.post("/api/" + TEST_EVENT_NAME + "/members/",
+                           json=_get_member_json("J\u00e4rvi \"JJ\""))
+        assert resp.status_code == 201
+        resp = client.post("/api/" + TEST_EVENT_NAME + "/bets/J\u00e4rvi \"JJ\"/",
+                    json=_get_bet_json("1", 2, 1))
+        for url in ["/api/events/",
+                    "/api/" + TEST_EVENT_NAME + "/games/",
+                    "/api/" + TEST_EVENT_NAME + "/members/",
+                    "/api/" + TEST_EVENT_NAME + "/bets/",
+                    "/api/" + TEST_EVENT_NAME + "/bets/game/1/",
+                    "/api/" + TEST_EVENT_NAME + "/bets/J\u00e4rvi \"JJ\"/",
+                    "/api/" + TEST_EVENT_NAME + "/betstatus/",
+                    "/api/" + TEST_EVENT_NAME + "/betstatus/?limit=2"]:
+            resp = client.get(url)
+            assert resp.status_code == 200
+            assert resp.data == json.dumps(json.loads(resp.data)).encode()
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/members/")
+        member = [item for item in json.loads(resp.data)["items"]
+                  if item["nickname"] == "J\u00e4rvi \"JJ\""][0]
+        assert client.get(member["@controls"]["self"]["href"]).status_code == 200
+
+class TestUrlTemplates(object):
+
+    def test_href(self, client):
+        app = client.application
+        with app.test_request_context("/"):
+            event = Event.query.filter_by(name=TEST_EVENT_NAME).first()
+            game = event.games[0]
+            member = Member(nickname="J\u00e4rvi \"JJ\" 50%", event=event)
+            for endpoint, values in [("api.eventcollection", {}),
+                                     ("api.eventitem", {"event": event}),
+                                     ("api.memberitem", {"event": event, "member": member}),
+                                     ("api.betsall", {"event": event, "game": None}),
+                                     ("api.betsall", {"event": event, "game": game}),
+                                     ("api.betstatus", {"event": event, "member": member})]:
+                assert urltemplates.href(endpoint, **values) == url_for(endpoint, **values)
+            assert urltemplates.href("api.memberitem", event=event, member=member) ==\
+                   "/api/" + TEST_EVENT_NAME + "/members/J%C3%A4rvi%20%22JJ%22%2050%25/"
+            assert ("api.memberitem", ("event", "member")) in\
+                   [key[1:] for key in app.extensions["url_templates"]]
+            # query string arguments are left to url_for()
+            assert urltemplates.href("api.betstatus", event=event, limit=2) ==\
+                   "/api/" + TEST_EVENT_NAME + "/betstatus/?limit=2"
+            db.session.rollback()
+
+class TestCompact(object):
+
+    RESOURCE_URL = "/api/" + TEST_EVENT_NAME + "/bets/"
+
+    def test_compact(self, client):
+        full = client.get(self.RESOURCE_URL)
+        resp = client.get(self.RESOURCE_URL + "?compact=1")
+        assert resp.status_code == 200
+        assert resp.headers["Content-Type"] == MASON + '; profile="compact"'
+        assert resp.headers["ETag"] != full.headers["ETag"]
+        body = json.loads(resp.data)
+        assert body["@controls"]["profile"]["href"] == "/profiles/bet/"
+        assert len(body["items"]) == len(json.loads(full.data)["items"])
+        for item in body["items"]:
+            assert list(item) == ["nickname", "game_nbr", "home_goals", "guest_goals"]
+            assert "home_team" in body["games"][item["game_nbr"]]
+        # negotiated with the Accept profile parameter too
+        headers = Headers({"Accept": MASON + '; profile="compact"'})
+        assert client.get(self.RESOURCE_URL, headers=headers).data == resp.data
+        assert client.get(self.RESOURCE_URL).data == full.data
+
+    def test_item_template(self, client):
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/games/?compact=1")
+        body = json.loads(resp.data)
+        control = body["@controls"]["item"]
+        assert control["isHrefTemplate"]
+        assert "@controls" not in body["items"][0]
+        resp = client.get(control["href"].replace("{game_nbr}", body["items"][0]["game_nbr"]))
+        assert resp.status_code == 200
+
+    def test_sparse_fields(self, client):
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/bets/mholappa/?compact=1&fields=game_nbr")
+        body = json.loads(resp.data)
+        assert body["nickname"] == "mholappa"
+        assert all(list(item) == ["game_nbr"] for item in body["items"])
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/members/?compact=1&fields=points")
+        assert resp.status_code == 400
+
+class TestBetsAllQueries(object):
+
+    def _count_queries(self, client, url):
+        queries = []
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            queries.append(statement)
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", count_query)
+        try:
+            resp = client.get(url)
+            assert resp.status_code == 200
+        finally:
+            event.remove(engine, "before_cursor_execute", count_query)
+        return len(json.loads(resp.data)["items"]), queries
+
+    def test_constant_queries(self, client):
+        urls = ["/api/" + TEST_EVENT_NAME + "/bets/",
+                "/api/" + TEST_EVENT_NAME + "/bets/game/1/"]
+        for url in urls:
+            client.get(url)
+        with client.application.app_context():
+            event_obj = Event.query.filter_by(name=TEST_EVENT_NAME).first()
+            responsecache.bump(event_obj.id)
+        before = [self._count_queries(client, url) for url in urls]
+        with client.application.app_context():
+            event_obj = Event.query.filter_by(name=TEST_EVENT_NAME).first()
+            for i in range(30):
+                member = Member(nickname="member-" + str(i), event=event_obj)
+                db.session.add(member)
+                for game in event_obj.games:
+                    db.session.add(Bet(member=member, game=game, home_goals=i, guest_goals=0))
+            db.session.commit()
+            responsecache.bump(event_obj.id)
+        after = [self._count_queries(client, url) for url in urls]
+        for (items_before, queries_before), (items_after, queries_after) in zip(before, after):
+            assert items_after > items_before
+            assert len(queries_after) == len(queries_before)
+        # the game filter is in the bet query
+        assert any("bet.game_id = " in statement for statement in after[1][1])
+
+class TestStreaming(object):
+
+    RESOURCE_URL = "/api/" + TEST_EVENT_NAME + "/bets/"
+
+    def test_streamed(self, client, monkeypatch):
+        # other path than RESOURCE_URL, not served from the same cache entry
+        full = client.get(self.RESOURCE_URL + "?all=1")
+        monkeypatch.setattr(serializer, "CHUNK_SIZE", 100)
+        resp = client.get(self.RESOURCE_URL, buffered=False)
+        assert resp.is_streamed
+        chunks = list(resp.iter_encoded())
+        resp.close()
+        assert len(chunks) > 2
+        # wire format is the same as with the whole body rendered at once
+        assert b"".join(chunks) == full.data
+        assert b"".join(chunks) == json.dumps(json.loads(b"".join(chunks))).encode()
+        # cached once streamed to the end
+        assert client.get(self.RESOURCE_URL).headers["X-Cache"] == "HIT"
+
+    def test_cache_size_limit(self, client):
+        client.application.config["RESPONSE_CACHE_MAX_SIZE"] = 100
+        client.get(self.RESOURCE_URL)
+        assert client.get(self.RESOURCE_URL).headers["X-Cache"] == "MISS"
+        client.application.config["RESPONSE_CACHE_MAX_SIZE"] = 1048576
+        client.get(self.RESOURCE_URL)
+        assert client.get(self.RESOURCE_URL).headers["X-Cache"] == "HIT"
+
+class TestCollectionPages(object):
+
+    def _walk(self, client, url, field):
+        pages = []
+        while url:
+            resp = client.get(url)
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            pages.append([item[field] for item in body["items"]])
+            url = body["@controls"].get("next", {}).get("href")
+        return pages, body
+
+    def test_members(self, client):
+        url = "/api/" + TEST_EVENT_NAME + "/members/"
+        pages, body = self._walk(client, url + "?limit=2", "nickname")
+        assert pages == [["ahilmola", "mholappa"], ["pohtonen"]]
+        resp = client.get(body["@controls"]["prev"]["href"])
+        assert [item["nickname"] for item in json.loads(resp.data)["items"]] ==\
+               ["ahilmola", "mholappa"]
+        resp = client.get(body["@controls"]["first"]["href"])
+        assert [item["nickname"] for item in json.loads(resp.data)["items"]] ==\
+               ["ahilmola", "mholappa"]
+        # unpaged collections have no page controls
+        body = json.loads(client.get(url).data)
+        assert not {"next", "prev", "first"} & set(body["@controls"])
+
+    def test_bets_and_games(self, client):
+        url = "/api/" + TEST_EVENT_NAME + "/bets/?limit=4&compact=1"
+        pages, body = self._walk(client, url, "game_nbr")
+        assert len(pages) == 2
+        assert sum(pages, []) == sorted(sum(pages, []))
+        assert "compact=1" in body["@controls"]["prev"]["href"]
+        # the game table has the games of the page only
+        assert set(body["games"]) == set(pages[-1])
+        pages, body = self._walk(client, "/api/" + TEST_EVENT_NAME + "/games/?limit=1",
+                                 "game_nbr")
+        assert pages == [["1"], ["2"], ["3"], ["4"]]
+        pages, body = self._walk(client, "/api/events/?limit=1", "name")
+        assert pages == [[TEST_EVENT_NAME]]
+
+    def test_max_page_size(self, client):
+        url = "/api/" + TEST_EVENT_NAME + "/members/"
+        client.application.config["MAX_PAGE_SIZE"] = 2
+        resp = client.get(url + "?limit=3")
+        assert resp.status_code == 400
+        body = json.loads(client.get(url).data)
+        assert len(body["items"]) == 2
+        assert "next" in body["@controls"]
+        resp = client.get(url + "?cursor=invalid")
+        assert resp.status_code == 400
+
+class TestBetsBatch(object):
+
+    RESOURCE_URL = "/api/" + TEST_EVENT_NAME + "/bets/mholappa/batch/"
+
+    def test_post(self, client):
+        status = json.loads(client.get("/api/" + TEST_EVENT_NAME + "/betstatus/mholappa/").data)
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/bets/mholappa/")
+        control = json.loads(resp.data)["@controls"]["sportbet:add-bets"]
+        assert control["href"] == self.RESOURCE_URL
+        bets = [_get_bet_json("1", 1, 1),
+                _get_bet_json("2", 2, 3),
+                _get_bet_json("3", 4, 0),
+                _get_bet_json("99", 1, 0),
+                _get_bet_json("3", 0, 0),
+                {"game_nbr": "4", "home_goals": -1, "guest_goals": 0}]
+        validate(bets[:3], control["schema"])
+        resp = client.post(self.RESOURCE_URL, json=bets)
+        assert resp.status_code == 200
+        items = json.loads(resp.data)["items"]
+        assert [(item["game_nbr"], item["status"]) for item in items] ==\
+               [("1", 204), ("2", 204), ("3", 201), ("99", 404), ("3", 409), ("4", 400)]
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/bets/mholappa/")
+        saved = {item["game_nbr"]: (item["home_goals"], item["guest_goals"])
+                 for item in json.loads(resp.data)["items"]}
+        assert saved["2"] == (2, 3)
+        assert saved["3"] == (4, 0)
+        assert "4" not in saved
+        # standings are the same as rebuilt from the bets
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["standings-rebuild"])
+        assert "0 members drifted" in result.output
+        assert json.loads(client.get("/api/" + TEST_EVENT_NAME +
+                                     "/betstatus/mholappa/").data)["points"] != status["points"]
+
+    def test_invalid(self, client):
+        resp = client.post(self.RESOURCE_URL, json={"game_nbr": "1"})
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, data="[]", content_type="text/plain")
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json=[])
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"] == []
+        client.application.config["BET_BATCH_MAX_SIZE"] = 1
+        resp = client.post(self.RESOURCE_URL, json=[_get_bet_json("1", 1, 1)] * 2)
+        assert resp.status_code == 400
+
+    def test_unsupported_database(self, client, monkeypatch):
+        monkeypatch.delitem(bet.UPSERT_INSERTS, "sqlite")
+        resp = client.post(self.RESOURCE_URL, json=[_get_bet_json("1", 2, 2)])
+        assert resp.status_code == 501
+        body = json.loads(client.get("/api/" + TEST_EVENT_NAME + "/bets/mholappa/").data)
+        assert (body["items"][0]["home_goals"], body["items"][0]["guest_goals"]) == (1, 1)
+
+"""
+Admin batch game result tests
+"""
+class TestGameResults(object):
+
+    RESOURCE_URL = "/api/" + TEST_EVENT_NAME + "/results/"
+    ADMIN_KEY = "adminTestKey"
+
+    def _admin_client(self, client):
+        app = client.application
+        with app.app_context():
+            db.session.add(ApiKey(key=ApiKey.key_hash(self.ADMIN_KEY), admin=True))
+            db.session.commit()
+        admin_client = FlaskClient(app, app.response_class)
+        return admin_client
+
+    def _put(self, admin_client, results):
+        return admin_client.put(self.RESOURCE_URL, json=results,
+                                headers={SPORTBET_API_KEY_NAME: self.ADMIN_KEY})
+
+    def test_put(self, client):
+        admin_client = self._admin_client(client)
+        def snapshot(game_nbr):
+            resp = client.get("/api/" + TEST_EVENT_NAME + "/betstatus/?after_game=" + game_nbr)
+            if resp.status_code != 200:
+                return resp.status_code
+            return [(item["nickname"], item["points"]) for item in json.loads(resp.data)["items"]]
+        # same results as in TestBetStatusAllCollection.test_snapshots, in one batch
+        resp = self._put(admin_client, [dict(_get_game_json("2"), game_nbr="2"),
+                                        dict(_get_game_json("1"), game_nbr="3")])
+        assert resp.status_code == 204
+        assert resp.headers["Location"].endswith("/api/" + TEST_EVENT_NAME + "/games/")
+        after_game2 = [("mholappa", 6), ("ahilmola", 4), ("pohtonen", 4)]
+        assert snapshot("2") == after_game2
+        assert snapshot("3") == after_game2
+        # correction of game2 shifts the later snapshots, game4 snapshot is taken after it
+        resp = self._put(admin_client, [{"game_nbr": "2", "home_goals": 2, "guest_goals": 3},
+                                        {"game_nbr": "4", "home_goals": 0, "guest_goals": 0}])
+        assert resp.status_code == 204
+        corrected = [("mholappa", 3), ("ahilmola", 2), ("pohtonen", 2)]
+        assert snapshot("2") == corrected
+        assert snapshot("3") == corrected
+        assert snapshot("4") == corrected
+        # game2 result reset removes its snapshot
+        resp = self._put(admin_client, [{"game_nbr": "2", "home_goals": -1, "guest_goals": -1}])
+        assert resp.status_code == 204
+        assert snapshot("2") == 404
+        resp = client.get("/api/" + TEST_EVENT_NAME + "/betstatus/")
+        assert [(item["nickname"], item["points"]) for item in json.loads(resp.data)["items"]] ==\
+            snapshot("4")
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["standings-rebuild", "--check"])
+        assert "0 members drifted" in result.output
+
+    def test_all_or_nothing(self, client):
+        admin_client = self._admin_client(client)
+        game_url = "/api/" + TEST_EVENT_NAME + "/games/1/"
+        result = {"game_nbr": "1", "home_goals": 5, "guest_goals": 0}
+        for results, status in [([result, dict(result, game_nbr="99")], 404),
+                                ([result, {"game_nbr": "2", "home_goals": "x",
+                                           "guest_goals": 0}], 400),
+                                ([result, {"home_goals": 1, "guest_goals": 0}], 400),
+                                ([result, result], 409),
+                                (result, 400)]:
+            assert self._put(admin_client, results).status_code == status
+            assert json.loads(client.get(game_url).data)["home_goals"] == 1
+        resp = admin_client.put(self.RESOURCE_URL, data="[]", content_type="text/plain",
+                                headers={SPORTBET_API_KEY_NAME: self.ADMIN_KEY})
+        assert resp.status_code == 415
+        client.application.config["RESULT_BATCH_MAX_SIZE"] = 1
+        resp = self._put(admin_client, [result, dict(result, game_nbr="2")])
+        assert resp.status_code == 400
+
+    def test_admin_only(self, client):
+        resp = client.put(self.RESOURCE_URL, json=[])
+        assert resp.status_code == 403
+        admin_client = self._admin_client(client)
+        assert admin_client.put(self.RESOURCE_URL, json=[]).status_code == 403
+        assert self._put(admin_client, []).status_code == 204
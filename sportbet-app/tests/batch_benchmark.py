@@ -0,0 +1,75 @@
+"""
+Benchmark for bet submission: one POST per bet to /<event>/bets/<member>/
+vs. one POST of all bets to /<event>/bets/<member>/batch/.
+
+Run "python batch_benchmark.py [bet_count]" in this file's folder.
+Default bet count is 200 (games in the event), posted for two members:
+one with the single-bet endpoint and one with the batch endpoint.
+"""
+import os
+import sys
+import tempfile
+import time
+
+from sportbet import create_app, db
+from sportbet.models import Event, Member, Game, ApiKey
+
+EVENT_NAME = "Benchmark-Event"
+KEY = "benchmarkKey"
+
+def _app(count):
+    """ App with a temporary database: an event with count games and two members """
+    db_fd, db_fname = tempfile.mkstemp()
+    os.close(db_fd)
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+                      "CACHE_TYPE": "SimpleCache",
+                      "BET_BATCH_MAX_SIZE": count})
+    with app.app_context():
+        db.create_all()
+        event = Event(name=EVENT_NAME)
+        for nbr in range(1, count + 1):
+            event.games.append(Game(game_nbr=str(nbr), home_team="Home-" + str(nbr),
+                                    guest_team="Guest-" + str(nbr),
+                                    home_goals=-1, guest_goals=-1))
+        event.members.append(Member(nickname="single"))
+        event.members.append(Member(nickname="batch"))
+        db.session.add(event)
+        db.session.add(ApiKey(key=ApiKey.key_hash(KEY), admin=False, event=event))
+        db.session.commit()
+    return app, db_fname
+
+def _bets(count):
+    return [{"game_nbr": str(nbr), "home_goals": nbr % 5, "guest_goals": nbr % 3}
+            for nbr in range(1, count + 1)]
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def _single(client, bets):
+    for bet in bets:
+        resp = client.post("/api/" + EVENT_NAME + "/bets/single/", json=bet,
+                           headers={"Sportbet-Api-Key": KEY})
+        assert resp.status_code == 201
+
+def _batch(client, bets):
+    resp = client.post("/api/" + EVENT_NAME + "/bets/batch/batch/", json=bets,
+                       headers={"Sportbet-Api-Key": KEY})
+    assert resp.status_code == 200
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    app, db_fname = _app(count)
+    client = app.test_client()
+    bets = _bets(count)
+    print("Bets: " + str(count))
+    single = _timed(_single, client, bets)
+    batch = _timed(_batch, client, bets)
+    print("single-bet POSTs: %.3f s (%.0f bets/s)" % (single, count / single))
+    print("batch POST:       %.3f s (%.0f bets/s, %.1fx)" %
+          (batch, count / batch, single / batch))
+    os.unlink(db_fname)
+
+if __name__ == "__main__":
+    main()
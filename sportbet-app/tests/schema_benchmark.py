@@ -0,0 +1,50 @@
+"""
+Micro-benchmark for request body validation: jsonschema.validate() with a
+schema built for each request vs. the compiled validators of sportbet.utils.
+
+Run "python schema_benchmark.py [request_count]" in this file's folder.
+Default request count is 2000, for each of the request body schemas.
+"""
+import sys
+import time
+
+from jsonschema import validate
+
+from sportbet.utils import REQUEST_SCHEMAS, validate_json
+
+# valid request bodies for the request body schemas (same order)
+BODIES = [
+    {"nickname": "mholappa"},
+    {"game_nbr": "1", "home_team": "OPS", "guest_team": "OLS",
+     "home_goals": -1, "guest_goals": -1},
+    {"home_goals": 3, "guest_goals": 2},
+    {"game_nbr": "1", "home_goals": 3, "guest_goals": 2},
+]
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def _per_request(count, model, variant, body):
+    # schema dict and validator class rebuilt for every request
+    schema_method = model.json_schema.__wrapped__
+    for _ in range(count):
+        validate(body, schema_method(**variant))
+
+def _compiled(count, model, variant, body):
+    for _ in range(count):
+        validate_json(body, model, **variant)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print("Requests per schema: " + str(count))
+    for (model, variant), body in zip(REQUEST_SCHEMAS, BODIES):
+        name = model.__name__ + str(variant)
+        per_request = _timed(_per_request, count, model, variant, body)
+        compiled = _timed(_compiled, count, model, variant, body)
+        print("%-30s validate(): %.3f s, compiled: %.3f s (%.1fx)" %
+              (name, per_request, compiled, per_request / compiled))
+
+if __name__ == "__main__":
+    main()
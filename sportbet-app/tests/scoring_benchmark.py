@@ -0,0 +1,57 @@
+"""
+Micro-benchmark for bet scoring: batch scorer vs. scoring bets one by one.
+
+Run "python scoring_benchmark.py [bet_count]" in this file's folder.
+Default bet count is one million synthetic bets, with 10% of the
+games not played yet (goals -1).
+"""
+import random
+import sys
+import time
+
+from sportbet import scoring
+
+def _synthetic_bets(count, seed=1):
+    """ Random bet and result goals, about 10% of results not played yet """
+    rnd = random.Random(seed)
+    bet_home = [rnd.randint(0, 6) for _ in range(count)]
+    bet_guest = [rnd.randint(0, 6) for _ in range(count)]
+    game_home = []
+    game_guest = []
+    for _ in range(count):
+        if rnd.random() < 0.1:
+            game_home.append(-1)
+            game_guest.append(-1)
+        else:
+            game_home.append(rnd.randint(0, 6))
+            game_guest.append(rnd.randint(0, 6))
+    return bet_home, bet_guest, game_home, game_guest
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+def _one_by_one(bet_home, bet_guest, game_home, game_guest):
+    return [scoring.bet_points(*goals) for goals in zip(bet_home, bet_guest, game_home, game_guest)]
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    goals = _synthetic_bets(count)
+    print("Bets: " + str(count) + ", NumPy: " + ("yes" if scoring.np is not None else "no"))
+
+    expected, seconds = _timed(_one_by_one, *goals)
+    print("bet_points() one by one: %.3f s" % seconds)
+
+    if scoring.np is not None:
+        arrays = [scoring.np.asarray(values, dtype=scoring.np.int32) for values in goals]
+        points, seconds = _timed(scoring.score_batch, *arrays)
+        print("score_batch() on arrays: %.3f s" % seconds)
+    points, seconds = _timed(scoring.score_batch, *goals)
+    print("score_batch() on lists:  %.3f s" % seconds)
+
+    assert list(points) == expected
+    print("Results identical, total points " + str(sum(expected)))
+
+if __name__ == "__main__":
+    main()